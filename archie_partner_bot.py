@@ -1,11 +1,19 @@
-from telegram.ext import Updater, Dispatcher
+from telegram.ext import Updater, Dispatcher, TypeHandler
+from telegram.utils.request import Request
 import telegram
-import commands
-import chat
+import scheduler
+import config
+import metrics
+import redis_supervisor
+from webhook import start_webhook
+from outbound import ThrottledBot, GLOBAL_RATE
+from sharding import ShardRouter, serve_shard
+from traffic import TrafficRecorder
 
 import os
-import sys
 import logging
+import signal
+from threading import Thread
 
 
 file_path = os.path.dirname(__file__)
@@ -19,8 +27,15 @@ _token_path = os.path.join(file_path, '_token')
 with open(_token_path, 'r') as rf:
     _token = rf.read().replace('\n', '')
 
-updater = Updater(token=_token, workers=16)
-dispatcher = updater.dispatcher
+# handlers run on scheduler.LANES, the dispatcher pool only serves plain @run_async functions
+workers = 4
+
+
+def build_updater(global_rate=GLOBAL_RATE):
+    # every lane worker may send at the same time, plus dispatcher, updater and job queue
+    con_pool_size = sum(lane.workers for lane in scheduler.LANES.values()) + workers + 3
+    bot = ThrottledBot(token=_token, request=Request(con_pool_size=con_pool_size), global_rate=global_rate)
+    return Updater(bot=bot, workers=workers)
 
 
 def error_callback(bot: telegram.Bot, update: telegram.Update, error: telegram.TelegramError):
@@ -30,10 +45,93 @@ def error_callback(bot: telegram.Bot, update: telegram.Update, error: telegram.T
     )
 
 
-for handler in commands.COMMAND_HANDLERS:
-    dispatcher.add_handler(handler)
-for handler in chat.MESSAGE_HANDLERS:
-    dispatcher.add_handler(handler)
+def add_handlers(dispatcher: Dispatcher):
+    # imported here, so the front process of shard mode does not load handler modules
+    import commands
+    import chat
+    import manage_commands
+    import inline
+
+    for handler in commands.COMMAND_HANDLERS:
+        dispatcher.add_handler(handler)
+    for handler in chat.MESSAGE_HANDLERS:
+        dispatcher.add_handler(handler)
+    for handler in inline.INLINE_HANDLERS:
+        dispatcher.add_handler(handler)
+
+    dispatcher.add_error_handler(error_callback)
+
+
+def run_shard(index, queue):
+    """
+    target of shard worker processes
+    """
+    if config.SNAPSHOT_FILE:
+        # shards hold different chats, so each keeps its own snapshot
+        config.SNAPSHOT_FILE = '{}.{}'.format(config.SNAPSHOT_FILE, index)
+    import gelbooru_commands
+
+    updater = build_updater(global_rate=GLOBAL_RATE / config.SHARDS)
+    add_handlers(updater.dispatcher)
+    scheduler.start()
+    metrics.start(
+        config.METRICS_LISTEN,
+        config.METRICS_PORT + 1 + index if config.METRICS_PORT else 0,
+        config.METRICS_SUMMARY_INTERVAL
+    )
+    try:
+        serve_shard(queue, updater)
+    finally:
+        # atexit functions are not called in processes started by multiprocessing
+        gelbooru_commands.save_data()
+
+
+def receive_updates(updater: Updater):
+    if config.TRAFFIC_LOG:
+        # group -1 runs before handlers of the default group
+        recorder = TrafficRecorder(config.TRAFFIC_LOG)
+        updater.dispatcher.add_handler(TypeHandler(telegram.Update, recorder.record), group=-1)
+    if config.BOT_MODE == 'webhook':
+        server = start_webhook(
+            updater,
+            config.WEBHOOK_LISTEN,
+            config.WEBHOOK_PORT,
+            config.WEBHOOK_PATH,
+            url=config.WEBHOOK_URL,
+            batch_size=config.WEBHOOK_BATCH_SIZE
+        )
+
+        def stop(signum, frame):
+            # shutdown() waits for serve_forever() to return, so it is called from another thread
+            Thread(target=server.shutdown, name='webhook_stop').start()
+
+        signal.signal(signal.SIGTERM, stop)
+        server.serve_forever()
+        server.server_close()
+        updater.job_queue.stop()
+        updater.dispatcher.stop()
+    else:
+        updater.start_polling()
+        updater.idle()
+
 
-dispatcher.add_error_handler(error_callback)
-updater.start_polling()
+if __name__ == "__main__":
+    # started once here, so shard processes find the servers running
+    redis_supervisor.start()
+    if config.SHARDS:
+        # front process: receive updates and route them to shard processes by chat id
+        router = ShardRouter(config.SHARDS, run_shard)
+        router.start()
+        metrics.start(config.METRICS_LISTEN, config.METRICS_PORT, config.METRICS_SUMMARY_INTERVAL)
+        updater = build_updater()
+        updater.dispatcher.add_handler(TypeHandler(telegram.Update, router.route))
+        try:
+            receive_updates(updater)
+        finally:
+            router.stop()
+    else:
+        updater = build_updater()
+        add_handlers(updater.dispatcher)
+        scheduler.start()
+        metrics.start(config.METRICS_LISTEN, config.METRICS_PORT, config.METRICS_SUMMARY_INTERVAL)
+        receive_updates(updater)
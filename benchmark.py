@@ -0,0 +1,143 @@
+"""
+Offline benchmark of the bot handlers against local stand-ins (see fakes.py).
+redis-server must be on PATH.
+
+Usage: python3 benchmark.py [workload ...] [--scale X] [--rate N] [--bot-latency S] ...
+
+Updates are paced at --rate and spread over many chats, so lanes are not flooded by default.
+Updates rejected by a full lane are reported apart, throughput and latency are of handled updates.
+
+Workloads:
+    repeat_tags     the same few tag queries sent again and again
+    browse          /img and /taxi without tags by chats with large seen-sets
+    calc            a storm of /calc formulas, a few of them too slow to finish
+    photo_tags      photos captioned "tags" sent in bursts
+"""
+import argparse
+import logging
+import random
+from time import time, sleep
+
+import metrics
+import scheduler
+from fakes import Harness
+
+
+def repeat_tags(harness, scale):
+    queries = ['tag_0', 'tag_1', 'tag_0 tag_2', 'tag_3 tag_5', 'tag_1 tag_4']
+    chats = [random.randint(1, 10 ** 6) for _ in range(int(100 * scale) or 1)]
+    for _ in range(int(400 * scale)):
+        yield harness.message(random.choice(chats), "/img " + random.choice(queries))
+
+
+def browse(harness, scale, seen=20000):
+    chats = [random.randint(1, 10 ** 6) for _ in range(int(25 * scale) or 1)]
+    # chats which have browsed for years
+    for chat_id in chats:
+        ids = random.sample(range(1, harness.viewer.MAX_ID + 1), min(seen, harness.viewer.MAX_ID // 2))
+        for i in range(0, len(ids), 10000):
+            harness.redis.conn.sadd(chat_id, *ids[i:i + 10000])
+    for _ in range(int(200 * scale)):
+        yield harness.message(random.choice(chats), random.choice(("/img", "/taxi")))
+
+
+def calc(harness, scale):
+    chats = [random.randint(1, 10 ** 6) for _ in range(int(200 * scale) or 1)]
+    for _ in range(int(500 * scale)):
+        if random.random() < 0.02:
+            formula = "9^9^9^9"
+        else:
+            formula = "({}+{})*{}/{}-{}^2".format(*(random.randint(1, 1000) for _ in range(5)))
+        yield harness.message(random.choice(chats), "/calc " + formula)
+
+
+def photo_tags(harness, scale):
+    chats = [random.randint(1, 10 ** 6) for _ in range(int(25 * scale) or 1)]
+    for _ in range(int(50 * scale)):
+        yield harness.message(random.choice(chats), photo=True, caption="tags")
+
+
+WORKLOADS = {
+    'repeat_tags': repeat_tags,
+    'browse': browse,
+    'calc': calc,
+    'photo_tags': photo_tags,
+}
+
+
+def run(harness, updates, rate=0.):
+    """
+    feed updates to harness and wait for all of them to be handled
+
+    :param rate: updates per second, 0 feeds as fast as possible
+
+    :return: (number of updates, number rejected by full lanes, seconds elapsed)
+    """
+    updates = list(updates)
+    metrics.reset()
+    harness.bot.calls.clear()
+    start = time()
+    for i, update in enumerate(updates):
+        if rate:
+            wait = start + i / rate - time()
+            if wait > 0:
+                sleep(wait)
+        harness.feed(update)
+    harness.wait_idle()
+    elapsed = time() - start
+    rejected = sum(metrics.counters.get('lane.{}.rejected'.format(lane), 0) for lane in scheduler.LANES)
+    return len(updates), rejected, elapsed
+
+
+def report(name, count, rejected, elapsed, harness):
+    handled = count - rejected
+    timings = metrics.snapshot()[0]
+    print("=== {} ===".format(name))
+    print("{} updates in {:.2f}s: {} handled, {} rejected by full lanes".format(count, elapsed, handled, rejected))
+    print("throughput of handled updates: {:.1f} updates/s".format(handled / elapsed if elapsed else 0.))
+    for lane in sorted(scheduler.LANES):
+        if 'lane.{}.latency'.format(lane) in timings:
+            handled_count, _, max_seconds, percentiles = timings['lane.{}.latency'.format(lane)]
+            print("latency of handled updates on {} lane: n={} {} max={:.1f}ms".format(
+                lane,
+                handled_count,
+                ' '.join("p{:g}={:.1f}ms".format(100 * p, 1000 * s) for p, s in percentiles.items()),
+                1000 * max_seconds
+            ))
+    print("Telegram API calls: {}".format(
+        ', '.join("{}={}".format(k, v) for k, v in sorted(harness.bot.calls.items()))
+    ))
+    print(metrics.summary())
+    print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark bot handlers offline")
+    parser.add_argument('workloads', nargs='*', help="workloads to run, all by default")
+    parser.add_argument('--scale', type=float, default=1., help="multiplier of chats and requests")
+    parser.add_argument('--rate', type=float, default=50., help="updates per second, 0 for no limit")
+    parser.add_argument('--bot-latency', type=float, default=0.05, help="seconds per Telegram call")
+    parser.add_argument('--gelbooru-latency', type=float, default=0.1, help="seconds per Gelbooru request")
+    parser.add_argument('--shortener-latency', type=float, default=0.01, help="seconds per shortener request")
+    parser.add_argument('--redis-port', type=int, default=16379)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    unknown = set(args.workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error("unknown workloads: {}".format(', '.join(sorted(unknown))))
+
+    # dropped tasks are counted in metrics, do not log each of them
+    logging.basicConfig(level=logging.ERROR)
+    random.seed(args.seed)
+    harness = Harness(
+        bot_latency=args.bot_latency,
+        gelbooru_latency=args.gelbooru_latency,
+        shortener_latency=args.shortener_latency,
+        redis_port=args.redis_port
+    )
+    try:
+        for name in args.workloads or sorted(WORKLOADS):
+            count, rejected, elapsed = run(harness, WORKLOADS[name](harness, args.scale), args.rate)
+            report(name, count, rejected, elapsed, harness)
+    finally:
+        harness.close()
@@ -1,20 +1,54 @@
+import os
+import logging
+from multiprocessing import TimeoutError
 import numpy
 import telegram
 from telegram.ext import MessageHandler
-from telegram.ext.dispatcher import run_async
 import filters
+from scheduler import run_scheduled, run_in_process
+import metrics
+import profiling
 from telegram.ext.filters import Filters
 from pickle import dump
 from gelbooru_commands import send_tags_info
 from io import BytesIO
 from resizeimage.resizeimage import resize_contain as resize
 from PIL import Image
+from GelbooruClassifier import classifier as classifier_module
 from GelbooruClassifier.classifier import GelbooruClassifier
+import config
+import mapped_weights
 
 MESSAGE_HANDLERS = []
+MAX_RECORD_SIZE = 4 * 1024 * 1024  # bytes of a message record file before it is rotated
+CLASSIFIER_PARAMS = 'logreg_params.h5'
+PREDICT_TIMEOUT = 30.  # seconds to wait for the classifier, so a lost pool worker never blocks a cpu lane thread
 img2arr = lambda img: numpy.array(img).flatten()
 std_size = (150, 100)
-classifier = GelbooruClassifier(params_name='logreg_params.h5')
+# weights are converted once and memory-mapped, so all processes share one copy
+classifier = mapped_weights.load_or_convert(
+    os.path.join(config.MODEL_DIR, os.path.splitext(CLASSIFIER_PARAMS)[0]),
+    lambda: GelbooruClassifier(params_name=CLASSIFIER_PARAMS),
+    source=os.path.join(os.path.dirname(classifier_module.__file__), CLASSIFIER_PARAMS)
+)
+
+
+def predict_tags(img_vec):
+    return classifier.predict_tags(numpy.array([img_vec]))[0]
+
+
+def predict_photo(data):
+    """
+    decode, resize and classify a photo, run in the cpu pool
+
+    :param data: bytes of photo file
+
+    :return: list of tags
+    """
+    image = Image.open(BytesIO(data))
+    image = resize(image, std_size)
+    image = image.convert("RGB")
+    return predict_tags(img2arr(image))
 
 
 def set_message_handler(
@@ -26,13 +60,24 @@ def set_message_handler(
         pass_chat_data=False,
         message_updates=True,
         channel_post_updates=True,
-        edited_updates=False
+        edited_updates=False,
+        lane=None
 ):
+    """
+    register the decorated function as a message handler
+
+    :param lane: name of the executor lane in scheduler.LANES to run the handler on.
+    If None, the handler runs in the dispatcher thread.
+    """
     def decorate(func):
+        name = 'message.{}'.format(func.__name__)
+        callback = profiling.profiled(name)(metrics.timed(name)(func))
+        if lane:
+            callback = run_scheduled(callback, lane)
         MESSAGE_HANDLERS.append(
             MessageHandler(
                 filters=set_filters,
-                callback=func,
+                callback=callback,
                 allow_edited=allow_edited,
                 pass_update_queue=pass_update_queue,
                 pass_job_queue=pass_job_queue,
@@ -47,8 +92,7 @@ def set_message_handler(
     return decorate
 
 
-@set_message_handler(set_filters=filters.test)
-@run_async
+@set_message_handler(set_filters=filters.test, lane='io')
 def echo(bot: telegram.bot.Bot, update: telegram.Update):
     bot.send_message(
         chat_id=update.message.chat_id,
@@ -56,8 +100,7 @@ def echo(bot: telegram.bot.Bot, update: telegram.Update):
     )
 
 
-@set_message_handler(set_filters=Filters.text)
-@run_async
+@set_message_handler(set_filters=Filters.text, lane='io')
 def record(bot: telegram.bot.Bot, update: telegram.Update):
     text = update.message.text
     if text.startswith("id:") and text[3:].strip().isdigit():
@@ -65,22 +108,32 @@ def record(bot: telegram.bot.Bot, update: telegram.Update):
     # just record message
     chat_id = update.message.chat_id
     # record messages using pickle
-    with open("message_of_{}".format(chat_id), "a+b") as record_file:
+    record_name = "message_of_{}".format(chat_id)
+    try:
+        # keep the previous part only, so records of a chat take at most 2 * MAX_RECORD_SIZE
+        if os.path.getsize(record_name) > MAX_RECORD_SIZE:
+            os.replace(record_name, record_name + ".1")
+    except FileNotFoundError:
+        pass
+    with open(record_name, "a+b") as record_file:
         dump(update.message, record_file)
 
 
 # image receiver: receive images with caption set to "tags"
-@set_message_handler(set_filters=Filters.photo)
-@run_async
+# the download is network I/O, so it runs on the io lane and only the classifier goes to the cpu pool
+@set_message_handler(set_filters=Filters.photo, lane='io')
 def photo_record(bot: telegram.Bot, update: telegram.Update):
     if update.message.caption and update.message.caption == "tags":
         photo_id = update.message.photo[0].file_id
         image_io = BytesIO()
-        bot.get_file(photo_id).download(out=image_io)
-        image = Image.open(image_io)
-        image = resize(image, std_size)
-        image = image.convert("RGB")
-        img_vec = img2arr(image)
-        tags = classifier.predict_tags(numpy.array([img_vec]))[0]
+        with metrics.timer('telegram.get_file'):
+            bot.get_file(photo_id).download(out=image_io)
+        try:
+            with metrics.timer('classifier.predict'):
+                tags = run_in_process(predict_photo, image_io.getvalue(), timeout=PREDICT_TIMEOUT)
+        except TimeoutError:
+            metrics.incr('classifier.timeout')
+            logging.warning("classifier did not answer in {}s".format(PREDICT_TIMEOUT))
+            return
         update.message.reply_text("tags:" + ','.join(tags))
 
@@ -1,15 +1,17 @@
 import os
-from multiprocessing import Process, Manager, Value
+from multiprocessing import TimeoutError
 
 import telegram
 from telegram.ext import CommandHandler
-from telegram.ext.dispatcher import run_async
 
 
 from calc import calc
 from recycle_cache import RecycleCache
 from videos_fetcher import get_info, download
+from scheduler import run_scheduled, run_killable
 import redis_dao
+import metrics
+import profiling
 
 COMMAND_HANDLERS = []  # list of command_handlers
 
@@ -30,13 +32,24 @@ def set_command_handler(
         pass_update_queue=False,
         pass_job_queue=False,
         pass_user_data=False,
-        pass_chat_data=False
+        pass_chat_data=False,
+        lane=None
 ):
+    """
+    register the decorated function as a command handler
+
+    :param lane: name of the executor lane in scheduler.LANES to run the handler on.
+    If None, the handler runs in the dispatcher thread.
+    """
     def decorate(func):
+        name = 'command.{}'.format(command)
+        callback = profiling.profiled(name)(metrics.timed(name)(func))
+        if lane:
+            callback = run_scheduled(callback, lane)
         COMMAND_HANDLERS.append(
             CommandHandler(
                 command=command,
-                callback=func,
+                callback=callback,
                 filters=filters,
                 allow_edited=allow_edited,
                 pass_args=pass_args,
@@ -51,8 +64,7 @@ def set_command_handler(
     return decorate
 
 
-@set_command_handler('start')
-@run_async
+@set_command_handler('start', lane='io')
 def hello(bot, update):
     bot.send_message(
         chat_id=update.message.chat_id,
@@ -65,9 +77,8 @@ My core is shared on https://github.com/ArchieMeng/archie_partner_bot
     )
 
 
-@set_command_handler('you-get', pass_args=True)
+@set_command_handler('you-get', pass_args=True, lane='long')
 def you_get_download(bot: telegram.Bot, update: telegram.Update, args):
-    # Todo support concurrent programming
     chat_id = update.message.chat_id
     message_id = update.message.message_id
 
@@ -117,15 +128,14 @@ def you_get_download(bot: telegram.Bot, update: telegram.Update, args):
         )
 
 
-def calculate_impl(formula, result: Value):
+def calculate_impl(formula):
     try:
-        result.value = str(calc(formula))
+        return str(calc(formula))
     except Exception as e:
-        result.value = e.args[0]
+        return e.args[0]
 
 
-@set_command_handler('calc', pass_args=True, allow_edited=True)
-@run_async
+@set_command_handler('calc', pass_args=True, allow_edited=True, lane='cpu')
 def calculate(bot: telegram.Bot, update: telegram.Update, args):
     def send_message(text):
         message = update.message or update.edited_message
@@ -145,15 +155,9 @@ def calculate(bot: telegram.Bot, update: telegram.Update, args):
     if args:
         formula = ''.join(args)
 
-        with Manager() as manager:
-            result = manager.Value('s', " ")
-            process = Process(target=calculate_impl, args=(formula, result))
-            process.start()
-            process.join(calc_timeout)
-            if process.is_alive():
-                process.terminate()
-                send_message("Time Limit Exceeded")
-            else:
-                send_message(result.value)
+        try:
+            send_message(run_killable(calculate_impl, formula, timeout=calc_timeout))
+        except TimeoutError:
+            send_message("Time Limit Exceeded")
     else:
         send_message("Usage: /calc <formula>. Currently, +-*/()^ operator is supported")
@@ -0,0 +1,51 @@
+import os
+
+# how updates are received: "polling" or "webhook"
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+
+# webhook mode
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+# public url registered to Telegram by set_webhook. Not registered if empty,
+# e.g. when a reverse proxy or the fake sender posts the updates.
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_BATCH_SIZE = 64  # max updates decoded at a time
+
+# number of worker processes sharded by chat id. 0 runs everything in one process.
+SHARDS = int(os.environ.get('BOT_SHARDS', 0))
+
+# metrics endpoint, see metrics.py. Shard workers listen on METRICS_PORT + 1 + shard index.
+METRICS_LISTEN = os.environ.get('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))  # 0 disables the endpoint
+METRICS_SUMMARY_INTERVAL = int(os.environ.get('METRICS_SUMMARY_INTERVAL', 600))  # seconds, 0 disables
+
+# compact log of every incoming update, replayed by replay.py. Not recorded if empty.
+TRAFFIC_LOG = os.environ.get('TRAFFIC_LOG', '')
+
+# user ids allowed to run admin commands, separated by commas
+ADMIN_IDS = {int(i) for i in os.environ.get('BOT_ADMINS', '').split(',') if i.strip()}
+
+# kill -USR1 <pid> profiles the next PROFILE_SIGNAL_CALLS calls of PROFILE_SIGNAL_HANDLER
+PROFILE_SIGNAL_HANDLER = os.environ.get('PROFILE_SIGNAL_HANDLER', 'command.img')
+PROFILE_SIGNAL_CALLS = int(os.environ.get('PROFILE_SIGNAL_CALLS', 20))
+
+# pictures are not sent again to a chat within the last SEEN_WINDOW_DAYS days or SEEN_WINDOW_SIZE pictures.
+# Both 0 keeps every picture ever sent as seen.
+SEEN_WINDOW_DAYS = float(os.environ.get('SEEN_WINDOW_DAYS', 0))
+SEEN_WINDOW_SIZE = int(os.environ.get('SEEN_WINDOW_SIZE', 0))
+
+# local redis servers started by redis_supervisor.py: seen pictures and recent ids persist on REDIS_PORT,
+# caches go to REDIS_LRU_PORT which evicts least recently used keys beyond REDIS_LRU_MAXMEMORY
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 12710))
+REDIS_LRU_PORT = int(os.environ.get('REDIS_LRU_PORT', 12711))
+REDIS_LRU_MAXMEMORY = os.environ.get('REDIS_LRU_MAXMEMORY', '256mb')
+REDIS_DIR = os.environ.get('REDIS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'redis'))
+
+# converted model weights, memory-mapped by every process, see mapped_weights.py
+MODEL_DIR = os.environ.get('MODEL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models'))
+
+# caches and tag index are written to SNAPSHOT_FILE every SNAPSHOT_INTERVAL seconds and at exit,
+# and mapped back at startup, see snapshot.py. Shards add their index to the name. Not written if empty.
+SNAPSHOT_FILE = os.environ.get('SNAPSHOT_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshot.bin'))
+SNAPSHOT_INTERVAL = int(os.environ.get('SNAPSHOT_INTERVAL', 600))  # seconds, 0 only writes at exit
@@ -0,0 +1,74 @@
+"""
+Post recorded updates to a local webhook server, standing in for Telegram.
+
+Usage: python3 fake_sender.py updates.jsonl [--url URL] [--batch N] [--interval SECONDS]
+
+updates.jsonl holds one update dict (as returned by getUpdates) per line.
+"""
+import argparse
+import json
+from time import sleep, time
+
+from requests import Session
+
+import config
+
+
+def read_updates(file_name):
+    with open(file_name, 'r') as fp:
+        for line in fp:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def send_updates(updates, url, batch_size=1, interval=0.):
+    """
+    post updates to url
+
+    :param updates: iterable of update dicts
+
+    :param url: webhook url
+
+    :param batch_size: updates per request. Telegram posts 1, bigger batches stress the server.
+
+    :param interval: seconds to wait between requests
+
+    :return: number of updates sent
+    """
+    sent = 0
+    with Session() as session:
+        batch = []
+        for update in updates:
+            batch.append(update)
+            if len(batch) >= batch_size:
+                sent += post(session, url, batch)
+                batch = []
+                if interval:
+                    sleep(interval)
+        if batch:
+            sent += post(session, url, batch)
+    return sent
+
+
+def post(session, url, batch):
+    response = session.post(url, json=batch[0] if len(batch) == 1 else batch)
+    response.raise_for_status()
+    return len(batch)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="post recorded updates to a webhook")
+    parser.add_argument('updates', help="file of updates, one JSON update per line")
+    parser.add_argument(
+        '--url',
+        default="http://{}:{}{}".format(config.WEBHOOK_LISTEN, config.WEBHOOK_PORT, config.WEBHOOK_PATH)
+    )
+    parser.add_argument('--batch', type=int, default=1, help="updates per request")
+    parser.add_argument('--interval', type=float, default=0., help="seconds between requests")
+    args = parser.parse_args()
+
+    start = time()
+    count = send_updates(read_updates(args.updates), args.url, args.batch, args.interval)
+    elapsed = time() - start
+    print("sent {} updates in {:.3f}s ({:.1f} updates/s)".format(count, elapsed, count / elapsed if elapsed else 0))
@@ -0,0 +1,383 @@
+"""
+Local stand-ins of Telegram, Gelbooru, the url shortener and redis,
+used by benchmark.py and replay.py to drive handlers offline.
+"""
+import hashlib
+import random
+import shutil
+import subprocess
+import tempfile
+from collections import defaultdict, Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+from queue import Queue
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from time import sleep, time
+from urllib.parse import urlparse, parse_qs
+
+import numpy
+import redis
+import telegram
+from telegram.ext import Dispatcher
+from lru import LRU
+
+import config
+import redis_dao
+from gelbooru_client import GelbooruClient
+import scheduler
+
+# Constants
+BOT_USERNAME = 'archie_partner_bot'
+RATINGS = 'sqe'
+
+
+def delay(seconds):
+    """
+    sleep around seconds, to inject latency of a remote service
+    """
+    if seconds:
+        sleep(seconds * random.uniform(0.5, 1.5))
+
+
+class FakePicture:
+    def __init__(self, picture_id, tags, rating):
+        """
+        GelbooruPicture with synthetic values
+        """
+        self.picture_id = picture_id
+        self.tags = tags
+        self.rating = rating
+        self.width = 600 + picture_id % 1400
+        self.height = 600 + picture_id % 900
+        self.file_url = 'https://img.gelbooru.test/images/{}.jpg'.format(picture_id)
+        self.sample_url = 'https://img.gelbooru.test/samples/sample_{}.jpg'.format(picture_id)
+        self.preview_url = 'https://img.gelbooru.test/thumbnails/thumbnail_{}.jpg'.format(picture_id)
+        self.source = 'https://source.test/{}'.format(picture_id)
+
+
+class FakeViewer:
+    MAX_CACHE_SIZE = 4096
+
+    def __init__(self, posts=100000, tags=2000, tags_per_post=8, latency=0.1, seed=0):
+        """
+        GelbooruViewer serving synthetic posts. Tag popularity is skewed,
+        so low numbered tags like tag_0 match many posts.
+
+        :param posts: number of posts, with ids from 1 to posts
+
+        :param tags: number of distinct tags
+
+        :param tags_per_post: number of tags of each post
+
+        :param latency: seconds per upstream request
+
+        :param seed: random seed of the synthetic posts
+        """
+        self.MAX_ID = posts
+        self.latency = latency
+        self.cache = LRU(self.MAX_CACHE_SIZE)
+        self.posts = {}
+        self.index = defaultdict(set)  # tag -> ids of posts having it
+        rng = random.Random(seed)
+        for picture_id in range(1, posts + 1):
+            post_tags = sorted({'tag_{}'.format(int(tags * rng.random() ** 3)) for _ in range(tags_per_post)})
+            self.posts[picture_id] = FakePicture(picture_id, post_tags, RATINGS[picture_id % len(RATINGS)])
+            for tag in post_tags:
+                self.index[tag].add(picture_id)
+
+    def search_ids(self, tags):
+        """
+        :return: ids of posts with all tags, newest first.
+        An OR query of ids like {id:1 ~ id:2} gives those ids.
+        """
+        terms = ' '.join(tags)
+        if terms.startswith('{'):
+            ids = {int(term[len('id:'):]) for term in terms.strip('{}').split(' ~ ')}
+            return sorted((i for i in ids if i in self.posts), reverse=True)
+        ids = None
+        rating = None
+        for tag in tags:
+            if tag.startswith('rating:'):
+                rating = tag[len('rating:')]
+                continue
+            tag_ids = self.index.get(tag, set())
+            ids = tag_ids if ids is None else ids & tag_ids
+        ids = sorted(ids or (), reverse=True)
+        if rating:
+            ids = [i for i in ids if self.posts[i].rating == rating]
+        return ids
+
+    def get(self, id=None, limit=None, tags=None, pid=0, **kwargs):
+        if tags is not None:
+            # one page of a search
+            limit = limit or 100
+            delay(self.latency)
+            ids = self.search_ids(tags)[pid * limit:(pid + 1) * limit]
+            return [self.posts[i] for i in ids] or None
+
+        if id is None:
+            delay(self.latency)
+            return [self.posts[self.MAX_ID]]
+
+        picture_id = int(id)
+        if picture_id in self.cache:
+            return [self.cache[picture_id]]
+        delay(self.latency)
+        picture = self.posts.get(picture_id)
+        if picture is None:
+            return None
+        self.cache[picture_id] = picture
+        return [picture]
+
+    def get_all(self, tags, num=200, limit=10, thread_limit=1, **kwargs):
+        ids = self.search_ids(tags)[:num]
+
+        # one request per page, thread_limit pages at a time
+        pages = max(1, -(-len(ids) // limit))
+        delay(self.latency * -(-pages // thread_limit))
+        pictures = [self.posts[i] for i in ids]
+        for picture in pictures:
+            self.cache[picture.picture_id] = picture
+        return pictures or None
+
+
+class FakeFile:
+    def __init__(self, content):
+        self.content = content
+
+    def download(self, custom_path=None, out=None, timeout=None):
+        out.write(self.content)
+        return out
+
+
+def sample_image(size=(600, 400)):
+    """
+    :return: bytes of a synthetic PNG image
+    """
+    from PIL import Image
+
+    image = Image.fromarray(numpy.random.RandomState(0).randint(0, 255, size[::-1] + (3,), dtype=numpy.uint8))
+    image_io = BytesIO()
+    image.save(image_io, format='PNG')
+    return image_io.getvalue()
+
+
+class FakeBot:
+    def __init__(self, latency=0.05):
+        """
+        telegram.Bot which counts API calls instead of sending them
+
+        :param latency: seconds per API call
+        """
+        self.id = 1
+        self.username = BOT_USERNAME
+        self.first_name = 'Altair'
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = Lock()
+        self.image = None
+
+    def __reduce__(self):
+        # chat.record pickles messages together with their bot
+        return self.__class__, (self.latency,)
+
+    def call(self, method):
+        with self.lock:
+            self.calls[method] += 1
+        delay(self.latency)
+        return True
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.call('send_message')
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        return self.call('send_photo')
+
+    def send_document(self, chat_id, document, **kwargs):
+        return self.call('send_document')
+
+    def send_media_group(self, chat_id, media, **kwargs):
+        return self.call('send_media_group')
+
+    def send_chat_action(self, chat_id, action, **kwargs):
+        return self.call('send_chat_action')
+
+    def answer_inline_query(self, inline_query_id, results, **kwargs):
+        return self.call('answer_inline_query')
+
+    def get_file(self, file_id, **kwargs):
+        self.call('get_file')
+        if self.image is None:
+            self.image = sample_image()
+        return FakeFile(self.image)
+
+
+class FakeClassifier:
+    def __init__(self, features=150 * 100 * 3, tags=200, seed=0):
+        """
+        GelbooruClassifier with random weights, costing about the same CPU as the real one
+        """
+        rng = numpy.random.RandomState(seed)
+        self.weights = (rng.standard_normal((features, tags)) * 0.01).astype(numpy.float32)
+        self.tags = ['tag_{}'.format(i) for i in range(tags)]
+
+    def predict_tags(self, X):
+        scores = numpy.dot(X.astype(numpy.float32), self.weights)
+        return [[self.tags[i] for i in numpy.argsort(row)[-5:]] for row in scores]
+
+
+class ShortenerRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        delay(self.server.latency)
+        url = query.get('url', [''])[0]
+        body = 'http://s.test/{}'.format(hashlib.md5(url.encode('utf-8')).hexdigest()[:8]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ShortenerServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # io workers open many connections at once
+
+    def __init__(self, latency=0.01):
+        """
+        url shortener listening on a free local port, serving in a background thread
+        """
+        super().__init__(('127.0.0.1', 0), ShortenerRequestHandler)
+        self.latency = latency
+        self.address = '127.0.0.1:{}'.format(self.server_address[1])
+        Thread(target=self.serve_forever, name='fake_shortener', daemon=True).start()
+
+
+class LocalRedis:
+    def __init__(self, port):
+        """
+        throwaway redis-server without persistence
+        """
+        self.port = port
+        self.dir = tempfile.mkdtemp(prefix='bench_redis_')
+        self.process = subprocess.Popen(
+            ['redis-server', '--bind', '127.0.0.1', '--port', str(port),
+             '--save', '', '--appendonly', 'no', '--dir', self.dir],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.STDOUT
+        )
+        self.conn = redis.Redis(port=port)
+        for _ in range(100):
+            try:
+                self.conn.ping()
+                break
+            except redis.exceptions.ConnectionError:
+                sleep(0.05)
+        self.conn.flushall()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class Harness:
+    def __init__(
+            self,
+            bot_latency=0.05,
+            gelbooru_latency=0.1,
+            shortener_latency=0.01,
+            redis_port=16379,
+            posts=100000,
+            tags=2000
+    ):
+        """
+        Import the handler modules and replace their upstream services by local stand-ins.
+        Updates fed to the harness run through a dispatcher with all handlers registered.
+        """
+        self.redis = LocalRedis(redis_port)
+        # the redis supervisor finds it running instead of starting the bot's servers
+        config.REDIS_PORT = config.REDIS_LRU_PORT = redis_port
+        # every run starts cold and leaves no snapshot behind
+        config.SNAPSHOT_FILE = ''
+        import commands
+        import chat
+        import gelbooru_commands
+        import inline
+
+        self.shortener = ShortenerServer(shortener_latency)
+        self.viewer = FakeViewer(posts=posts, tags=tags, latency=gelbooru_latency)
+        gelbooru_commands.gelbooru_viewer = self.viewer
+        gelbooru_commands.gelbooru_client = GelbooruClient(self.viewer)
+        gelbooru_commands.SHORT_URL_ADDR = self.shortener.address
+        gelbooru_commands.picture_chat_id_dic = redis_dao.RedisSetDict(port=redis_port)
+        gelbooru_commands.recent_id_store = redis_dao.RedisHash(gelbooru_commands.RECENT_ID_KEY, port=redis_port)
+        # replaced before the cpu pool is forked, so pool processes use it too
+        chat.classifier = FakeClassifier()
+
+        self.bot = FakeBot(bot_latency)
+        self.dispatcher = Dispatcher(self.bot, Queue())
+        for handler in commands.COMMAND_HANDLERS + chat.MESSAGE_HANDLERS + inline.INLINE_HANDLERS:
+            self.dispatcher.add_handler(handler)
+        scheduler.start()
+        self.update_id = 0
+        self.lock = Lock()
+
+    def next_id(self):
+        with self.lock:
+            self.update_id += 1
+            return self.update_id
+
+    def message(self, chat_id, text=None, photo=False, caption=None, user_id=None):
+        """
+        :return: telegram.Update of a new message in chat_id
+        """
+        update_id = self.next_id()
+        message = {
+            'message_id': update_id,
+            'date': int(time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+            'from': {'id': user_id or abs(chat_id), 'first_name': 'bench', 'is_bot': False},
+        }
+        if text is not None:
+            message['text'] = text
+        if photo:
+            message['photo'] = [{'file_id': 'photo_{}'.format(update_id), 'width': 600, 'height': 400}]
+            message['caption'] = caption
+        return telegram.Update.de_json({'update_id': update_id, 'message': message}, self.bot)
+
+    def inline_query(self, user_id, query, offset=''):
+        """
+        :return: telegram.Update of a new inline query of user_id
+        """
+        update_id = self.next_id()
+        inline_query = {
+            'id': str(update_id),
+            'from': {'id': user_id, 'first_name': 'bench', 'is_bot': False},
+            'query': query,
+            'offset': offset,
+        }
+        return telegram.Update.de_json({'update_id': update_id, 'inline_query': inline_query}, self.bot)
+
+    def feed(self, update):
+        self.dispatcher.process_update(update)
+
+    def wait_idle(self, timeout=600.):
+        """
+        wait until every lane finished its tasks
+
+        :return: True if idle before timeout
+        """
+        deadline = time() + timeout
+        while time() < deadline:
+            if all(lane.is_idle() for lane in scheduler.LANES.values()):
+                return True
+            sleep(0.01)
+        return False
+
+    def close(self):
+        self.shortener.shutdown()
+        self.redis.stop()
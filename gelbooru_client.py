@@ -0,0 +1,171 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from time import sleep
+
+import metrics
+from resilience import CircuitBreaker, Started, submit, wait
+
+# Constants
+PAGE_SIZE = 20  # posts per page request
+PAGE_CONCURRENCY = 4  # page requests in flight per search
+PAGE_WORKERS = 16  # page requests in flight of all searches
+BATCH_WINDOW = 0.01  # seconds a single id lookup waits for others to join its query
+MAX_BATCH = 50  # ids merged into one query
+ID_QUERY = '{{{}}}'  # Gelbooru OR query of terms
+DEADLINE = 10.  # seconds to wait for a page or a picture once its request started
+QUEUE_TIMEOUT = 30.  # seconds a request may wait for a free worker before giving up
+
+
+class GelbooruClient:
+    def __init__(self, viewer, page_size=PAGE_SIZE, page_concurrency=PAGE_CONCURRENCY,
+                 page_workers=PAGE_WORKERS, batch_window=BATCH_WINDOW, max_batch=MAX_BATCH,
+                 deadline=DEADLINE, breaker: CircuitBreaker = None):
+        """
+        Fetch Gelbooru pictures through viewer, a GelbooruViewer.
+        Searches fetch pages concurrently and yield them in order as they arrive.
+        Concurrent lookups of the same id share one request, and lookups of different ids
+        arriving within batch_window are merged into one OR query.
+        Requests go through breaker, and waiting for one longer than deadline raises Unavailable.
+        Deadlines run from when a request starts, time queued for a worker is not counted.
+        It is threading-safe.
+
+        :param viewer: GelbooruViewer, which does the requests and holds the picture cache
+
+        :param page_size: posts per page request
+
+        :param page_concurrency: page requests in flight per search
+
+        :param page_workers: page requests in flight of all searches
+
+        :param batch_window: seconds a single id lookup waits for others to join its query
+
+        :param max_batch: ids merged into one query
+
+        :param deadline: seconds to wait for a page or a picture
+
+        :param breaker: CircuitBreaker of Gelbooru requests, a new one if None
+        """
+        self.viewer = viewer
+        self.page_size = page_size
+        self.page_concurrency = page_concurrency
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.deadline = deadline
+        self.breaker = breaker or CircuitBreaker('gelbooru', slow_call=deadline)
+        self.executor = ThreadPoolExecutor(max_workers=page_workers)
+        self.lock = threading.Lock()
+        self.pending = {}  # picture id -> Future of a lookup in flight
+        self.batch = None  # ids waiting to be fetched together
+        self.batch_started = None  # Started of the batch of ids waiting
+
+    def fetch_page(self, tags, pid):
+        with metrics.timer('gelbooru.page'):
+            pictures = self.breaker.call(self.viewer.get, tags=tags, pid=pid, limit=self.page_size) or []
+        for p in pictures:
+            self.viewer.cache[int(p.picture_id)] = p
+        return pictures
+
+    def search(self, tags, num=200, start_pid=0):
+        """
+        search pictures with all tags, page_concurrency pages at a time
+
+        :param tags: list of tags
+
+        :param num: max number of pictures
+
+        :param start_pid: index of the first page, to continue a search
+
+        :return: generator of pages, lists of pictures in result order.
+        Pages not yet requested when it is closed are never fetched.
+        """
+        pages = -(-num // self.page_size)
+        futures = {}
+        next_pid = start_pid
+        try:
+            for pid in range(start_pid, pages):
+                while next_pid < pages and next_pid < pid + self.page_concurrency:
+                    futures[next_pid] = submit(self.executor, self.fetch_page, tags, next_pid)
+                    next_pid += 1
+                page = wait(futures.pop(pid), self.deadline, self.breaker, QUEUE_TIMEOUT)
+                if page:
+                    yield page
+                if len(page) < self.page_size:
+                    break
+        finally:
+            for future in futures.values():
+                future.cancel()
+
+    def get(self, pic_id):
+        """
+        get picture by id
+
+        :return: list with the picture, or None if not found
+        """
+        pic_id = int(pic_id)
+        if pic_id in self.viewer.cache:
+            return self.viewer.get(id=pic_id)
+
+        leader = False
+        with self.lock:
+            future = self.pending.get(pic_id)
+            if future is None:
+                future = self.pending[pic_id] = Future()
+                if self.batch is None:
+                    batch = self.batch = [pic_id]
+                    self.batch_started = Started()
+                    leader = True
+                else:
+                    self.batch.append(pic_id)
+                    if len(self.batch) >= self.max_batch:
+                        self.batch = None
+                future.started = self.batch_started
+            else:
+                metrics.incr('gelbooru.coalesced')
+
+        if leader:
+            sleep(self.batch_window)
+            with self.lock:
+                if self.batch is batch:
+                    self.batch = None
+            submit(self.executor, self.fetch_batch, batch, started=future.started)
+        return wait(future, self.deadline, self.breaker, QUEUE_TIMEOUT)
+
+    def latest(self):
+        """
+        get the latest picture
+
+        :return: list with the picture
+        """
+        return wait(submit(self.executor, self.fetch_latest), self.deadline, self.breaker, QUEUE_TIMEOUT)
+
+    def fetch_latest(self):
+        with metrics.timer('gelbooru.get_latest'):
+            return self.breaker.call(self.viewer.get, limit=1)
+
+    def fetch_batch(self, ids):
+        results = {}
+        try:
+            if len(ids) > 1:
+                metrics.incr('gelbooru.batched', len(ids))
+                query = ID_QUERY.format(' ~ '.join('id:{}'.format(pic_id) for pic_id in ids))
+                with metrics.timer('gelbooru.get_batch'):
+                    pictures = self.breaker.call(self.viewer.get, tags=query.split(' '), limit=len(ids)) or []
+                wanted = set(ids)
+                for p in pictures:
+                    if int(p.picture_id) in wanted:
+                        self.viewer.cache[int(p.picture_id)] = p
+                        results[int(p.picture_id)] = [p]
+            for pic_id in ids:
+                if pic_id not in results:
+                    # not in a batch result, or alone: ask for it by id
+                    results[pic_id] = self.breaker.call(self.viewer.get, id=pic_id)
+        except Exception as e:
+            with self.lock:
+                futures = [self.pending.pop(pic_id) for pic_id in ids]
+            for future in futures:
+                future.set_exception(e)
+            return
+        with self.lock:
+            futures = [(self.pending.pop(pic_id), results[pic_id]) for pic_id in ids]
+        for future, result in futures:
+            future.set_result(result)
@@ -1,26 +1,38 @@
 import os
 
-from requests import get
+import requests
 from concurrent.futures import ThreadPoolExecutor
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
+from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, InputMediaPhoto
 import telegram
 import re
 import logging
-from commands import set_command_handler, run_async, is_public_chat
+from commands import set_command_handler, is_public_chat
+from functools import wraps
 
 from lru import LRU
 from GelbooruViewer import GelbooruPicture, GelbooruViewer
 from random import randint, seed
-from collections import defaultdict
+from itertools import chain
 import pickle
 import atexit
 import signal
 import sys
-from threading import Lock
 from io import BytesIO
+import threading
 from time import time
 from recycle_cache import RecycleCache
+from idle_dict import IdleDict
+from tag_table import intern_tags, tag_table
+from tag_index import TagIndex, normalize_query
+from gelbooru_client import GelbooruClient
+from resilience import CircuitBreaker, StaleCache, Unavailable
+from snapshot import Snapshot, SnapshotCache
+import snapshot
 import redis_dao
+import redis_supervisor
+import metrics
+import profiling
+import config
 
 
 # Constants
@@ -40,21 +52,91 @@ PIC_FORMAT_HTML = """
 """
 
 file_path = os.path.dirname(__file__)
-RECENT_ID_FILE_NAME = 'recent_id_cache.pickle'
+RECENT_ID_FILE_NAME = 'recent_id_cache.pickle'  # legacy store of recent ids, migrated to redis
+RECENT_ID_KEY = 'recent_picture_ids'  # redis hash of chat_id -> recent picture ids
 PIC_CACHE_FILE_NAME = 'picture_cache.pickle'
 SHORT_URL_ADDR = "localhost:1234"  # Todo change this when push to github
 SAFE_TAG = "rating:safe"
-REDIS_PORT = 12710
-REDIS_LRU_PORT = 12711
+REDIS_PORT = config.REDIS_PORT
+REDIS_LRU_PORT = config.REDIS_LRU_PORT
+MAX_ACTIVE_CHATS = 10000  # chats whose state is held in memory
+CHAT_IDLE_TIMEOUT = 3600  # seconds before state of an idle chat is dropped from memory
+TAG_REPLY_CACHE_SIZE = 4096  # rendered /tag replies kept
+SEARCH_SIZE = 200  # pictures of a tag search
+SEARCH_FRESH_TIME = 600  # seconds a cached search is served without refreshing
+SEARCH_MAX_STALE = 24 * 3600  # seconds a cached search is served while refreshing
+LATEST_FRESH_TIME = 60  # seconds the latest picture is served without refreshing
+SHORTENER_TIMEOUT = (1, 3)  # seconds to connect and to read from the shortener
+SHORTENER_POOL_SIZE = 64  # keep-alive connections to the shortener
+UNAVAILABLE_TEXT = "Gelbooru is not responding now, please try again later"
+MAX_MEDIA_GROUP_SIZE = 10  # Telegram sends at most 10 photos in a media group
+SHORT_URL_CACHE_SIZE = 100000  # url -> short url kept
 
 # global variables
 recent_cache_size = 6
-picture_chat_id_dic = redis_dao.RedisSetDict(port=REDIS_PORT)
-picture_chat_id_dic[0].ping()  # start redis server if not started
+if config.SEEN_WINDOW_DAYS or config.SEEN_WINDOW_SIZE:
+    # pictures are shown again once out of the window
+    picture_chat_id_dic = redis_dao.RedisSetDict(
+        port=REDIS_PORT,
+        set_class=redis_dao.RedisTimedSet,
+        set_kwargs={
+            'window': config.SEEN_WINDOW_DAYS * 24 * 3600 or None,
+            'size': config.SEEN_WINDOW_SIZE or None,
+        },
+        max_size=MAX_ACTIVE_CHATS,
+        idle_timeout=CHAT_IDLE_TIMEOUT
+    )
+else:
+    picture_chat_id_dic = redis_dao.RedisSetDict(
+        port=REDIS_PORT,
+        max_size=MAX_ACTIVE_CHATS,
+        idle_timeout=CHAT_IDLE_TIMEOUT
+    )
+redis_supervisor.wait_ready()  # servers are started by the front or single process
 gelbooru_viewer = GelbooruViewer()
-send_lock = Lock()
-recent_picture_id_caches = defaultdict(lambda: RecycleCache(recent_cache_size))
-gelbooru_viewer.cache = LRU(gelbooru_viewer.MAX_CACHE_SIZE)
+recent_id_store = redis_dao.RedisHash(RECENT_ID_KEY, port=REDIS_PORT)
+# snapshot of the previous run, its records are unpickled when first used
+warm_start = Snapshot(config.SNAPSHOT_FILE or None)
+gelbooru_viewer.cache = SnapshotCache(LRU(gelbooru_viewer.MAX_CACHE_SIZE), warm_start, 'pictures')
+gelbooru_client = GelbooruClient(gelbooru_viewer)
+search_cache = StaleCache('search_cache', 1024, SEARCH_FRESH_TIME, SEARCH_MAX_STALE)
+latest_cache = StaleCache('latest_cache', 1, LATEST_FRESH_TIME, SEARCH_MAX_STALE)
+shortener_breaker = CircuitBreaker('shortener')
+shortener_session = requests.Session()
+# io workers each resolve several urls at once
+shortener_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=SHORTENER_POOL_SIZE))
+tag_index = TagIndex()
+if warm_start.contains('tag_index', 'counts'):
+    tag_index.update(
+        warm_start.get('tag_index', 'counts'),
+        warm_start.get('tag_index', 'picture_ids') if warm_start.contains('tag_index', 'picture_ids') else ()
+    )
+short_urls = SnapshotCache(LRU(SHORT_URL_CACHE_SIZE), warm_start, 'short_urls')
+tag_replies = LRU(TAG_REPLY_CACHE_SIZE)  # (picture_id, fetch method) -> (text, reply_markup)
+
+
+def load_recent_ids(chat_id):
+    cache = RecycleCache(recent_cache_size)
+    for pic_id in recent_id_store.get(chat_id, [])[::-1]:
+        cache.add(pic_id)
+    return cache
+
+
+def save_recent_ids(chat_id, cache: RecycleCache):
+    pic_ids = [*cache]
+    if pic_ids:
+        recent_id_store[chat_id] = pic_ids
+
+
+# chat_id -> RecycleCache of pictures recently sent to the chat.
+# Chats are loaded from recent_id_store when used and written back when idle,
+# so only active chats are held in memory.
+recent_picture_id_caches = IdleDict(
+    load_recent_ids,
+    max_size=MAX_ACTIVE_CHATS,
+    idle_timeout=CHAT_IDLE_TIMEOUT,
+    on_evict=save_recent_ids
+)
 
 
 def load_data():
@@ -62,16 +144,13 @@ def load_data():
     load previous global data
     :return: None
     """
-    global recent_picture_id_caches
-
+    # move recent ids saved by older versions into redis
+    legacy_file_name = file_path + '/' + RECENT_ID_FILE_NAME
     try:
-        with open(file_path + '/' + RECENT_ID_FILE_NAME, 'rb') as fp:
+        with open(legacy_file_name, 'rb') as fp:
             caches_dict = pickle.load(fp)
-            # recent_id_caches contain a lambda function which can not be pickled
-            for k in caches_dict:
-                for v in caches_dict[k][::-1]:
-                    recent_picture_id_caches[k].add(v)
-
+        recent_id_store.update({k: v for k, v in caches_dict.items() if v})
+        os.rename(legacy_file_name, legacy_file_name + '.migrated')
     except FileNotFoundError:
         pass
 
@@ -92,13 +171,39 @@ def save_data():
     # with open(file_path + '/' + PIC_CHAT_DIC_FILE_NAME, 'wb') as fp:
     #     pickle.dump(picture_chat_id_dic, fp, protocol=2)
 
-    with open(file_path + '/' + RECENT_ID_FILE_NAME, 'wb') as fp:
-        # recent_id_caches contain a lambda function which can not be pickled
-        cache_dict = {k: [*recent_picture_id_caches[k]] for k in recent_picture_id_caches}
-        pickle.dump(cache_dict, fp, protocol=2)
+    # only chats held by this process are saved, others are kept in redis as they were
+    cache_dict = {k: [*cache] for k, cache in recent_picture_id_caches.items()}
+    recent_id_store.update({k: v for k, v in cache_dict.items() if v})
+
+    save_snapshot()
 
-    # with open(file_path + '/' + PIC_CACHE_FILE_NAME, 'wb') as fp:
-    #     pickle.dump(gelbooru_viewer.cache, fp, protocol=2)
+
+def snapshot_items(cache, limit):
+    if isinstance(cache, SnapshotCache):
+        return cache.snapshot_items(limit)
+    return list(cache.items())[:limit]
+
+
+snapshot_lock = threading.Lock()
+
+
+def save_snapshot():
+    """
+    write caches and tag index to config.SNAPSHOT_FILE, loaded back by the next start
+    """
+    if not config.SNAPSHOT_FILE:
+        return
+    with snapshot_lock, metrics.timer('snapshot.write'):
+        tag_counts, tag_picture_ids = tag_index.snapshot()
+        snapshot.write(config.SNAPSHOT_FILE, {
+            'pictures': snapshot_items(gelbooru_viewer.cache, gelbooru_viewer.MAX_CACHE_SIZE),
+            'short_urls': snapshot_items(short_urls, SHORT_URL_CACHE_SIZE),
+            'tag_index': [('counts', tag_counts), ('picture_ids', tag_picture_ids)],
+        })
+
+
+if config.SNAPSHOT_FILE and config.SNAPSHOT_INTERVAL:
+    snapshot.write_periodically(save_snapshot, config.SNAPSHOT_INTERVAL)
 
 
 def raise_exit(signum, stack):
@@ -108,6 +213,158 @@ def raise_exit(signum, stack):
 signal.signal(signal.SIGTERM, raise_exit)
 
 
+def profile_on_signal(signum, stack):
+    try:
+        profiling.arm(config.PROFILE_SIGNAL_HANDLER, config.PROFILE_SIGNAL_CALLS, 'all')
+    except ValueError as e:
+        logging.error("can not profile on signal: {}".format(e))
+
+
+signal.signal(signal.SIGUSR1, profile_on_signal)
+metrics.register_gauge('recent_picture_id_caches.size', lambda: len(recent_picture_id_caches))
+metrics.register_gauge('picture_chat_id_dic.size', lambda: len(picture_chat_id_dic))
+metrics.register_gauge('gelbooru_viewer.cache.size', lambda: len(gelbooru_viewer.cache))
+metrics.register_gauge('tag_table.size', lambda: len(tag_table))
+metrics.register_gauge('tag_index.size', lambda: len(tag_index))
+metrics.register_gauge('tag_replies.size', lambda: len(tag_replies))
+
+
+def get_picture(pic_id):
+    """
+    get picture by id
+
+    :param pic_id: picture id
+
+    :return: list with the picture, or an empty result if not found
+    """
+    metrics.hit('gelbooru.cache', int(pic_id) in gelbooru_viewer.cache)
+    with metrics.timer('gelbooru.get'):
+        return intern_tags(gelbooru_client.get(pic_id), tag_index.add)
+
+
+def load_latest_picture():
+    return intern_tags(gelbooru_client.latest(), tag_index.add)
+
+
+def get_latest_picture():
+    return latest_cache.get('latest', load_latest_picture)
+
+
+def load_search(tags):
+    """
+    :return: (all pages of search of tags, True), as cached in search_cache
+    """
+    return [intern_tags(page, tag_index.add) for page in gelbooru_client.search(tags, num=SEARCH_SIZE)], True
+
+
+def stream_pictures(tags):
+    """
+    search pictures with all tags, yielding pages as soon as they arrive.
+    Pages of recent searches are served from search_cache, and stale ones are
+    refreshed in the background. Expired ones are served only when Gelbooru is unavailable.
+
+    :param tags: list of tags
+
+    :return: generator of lists of pictures, empty if not found
+    """
+    if tag_index.is_known_empty(tags):
+        metrics.incr('tag_index.skipped_searches')
+        return
+    key = normalize_query(tags)
+    cached, age = search_cache.lookup(key)
+    pages, complete, expired = [], False, None
+    if age is not None and age < search_cache.max_stale:
+        metrics.hit(search_cache.name, True)
+        pages, complete = list(cached[0]), cached[1]
+        if age >= search_cache.fresh_time:
+            search_cache.refresh(key, lambda: load_search(tags))
+        for page in pages:
+            yield page
+    else:
+        metrics.hit(search_cache.name, False)
+        expired = cached
+    if complete:
+        return
+
+    fetched = False
+    try:
+        # continue after the cached pages, which are all full but the last one
+        for page in gelbooru_client.search(tags, num=SEARCH_SIZE, start_pid=len(pages)):
+            page = intern_tags(page, tag_index.add)
+            pages.append(page)
+            fetched = True
+            yield page
+        complete = True
+    except Unavailable:
+        if pages or not expired:
+            raise
+        metrics.incr('{}.served_expired'.format(search_cache.name))
+        for page in expired[0]:
+            yield page
+        return
+    finally:
+        if fetched or complete:
+            search_cache.put(key, (pages, complete))
+    if not pages:
+        tag_index.mark_empty(tags)
+
+
+def search_pictures(tags):
+    """
+    search pictures with all tags
+
+    :param tags: list of tags
+
+    :return: list of pictures, or an empty result if not found
+    """
+    return [p for page in stream_pictures(tags) for p in page]
+
+
+def tags_not_found_reply(tags, fetch_method):
+    """
+    reply to a search without results, suggesting known tags for the first unknown one
+
+    :param tags: list of searched tags
+
+    :param fetch_method: command of suggested searches, /img or /taxi
+
+    :return: (text, reply_markup)
+    """
+    text = "Tag: {tags} not found".format(tags=tags)
+    for i, tag in enumerate(tags):
+        # skip operators like -tag and meta tags like rating:safe
+        if tag in tag_index or tag.startswith('-') or ':' in tag:
+            continue
+        suggestions = tag_index.suggest(tag)
+        if suggestions:
+            buttons = [
+                KeyboardButton(" ".join([fetch_method] + tags[:i] + [suggestion] + tags[i + 1:]))
+                for suggestion in suggestions
+            ]
+            return text + "\nDid you mean: {}?".format(", ".join(suggestions)), ReplyKeyboardMarkup(
+                [buttons[j:j + 2] for j in range(0, len(buttons), 2)],
+                one_time_keyboard=True,
+                resize_keyboard=True
+            )
+        break
+    return text, ReplyKeyboardRemove()
+
+
+
+@metrics.timed('shortener')
+def request_short_url(url: str):
+    response = shortener_session.get(
+        "http://{}/shorten/".format(SHORT_URL_ADDR),
+        params={
+            "url": url
+        },
+        timeout=SHORTENER_TIMEOUT
+    )
+    # count server errors as failures of the shortener
+    if response.status_code >= 500:
+        response.raise_for_status()
+    return response
+
 
 def url2short(url: str):
     """
@@ -118,20 +375,22 @@ def url2short(url: str):
     :return: short_url
     """
     if url:
+        short_url = short_urls.get(url)
+        metrics.hit('short_urls', short_url is not None)
+        if short_url is not None:
+            return short_url
         try:
-            req = get(
-                "http://{}/shorten/".format(SHORT_URL_ADDR),
-                params={
-                    "url": url
-                }
-            )
+            req = shortener_breaker.call(request_short_url, url)
             # logging.info("url2short request status code", req.status_code)
             # logging.info("url2short request content", req.content)
             if req.status_code >= 400:
                 return url
             else:
                 short_url = req.text
+                short_urls[url] = short_url
                 return short_url
+        except Unavailable:
+            pass
         except Exception as e:
             print(type(e), e)
     return url
@@ -144,7 +403,7 @@ def get_img(url: str):
     :return:
     """
     file_name = url.split('/')[-1]
-    response = get(
+    response = requests.get(
         url,
         headers={
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
@@ -160,41 +419,29 @@ def get_img(url: str):
         return None
 
 
-def send_picture(
-        bot: telegram.bot.Bot,
-        chat_id,
-        message_id,
-        p: GelbooruPicture,
-        use_short_url=True
-):
-    """
-    Used to send Gelbooru picture
-
-    :param bot: Telegrambot object
+def get_correct_url(url: str):
+    # use regular expression in case of wrong url format
+    if url:
+        try:
+            return re.findall(r'((http|https)://.*)', url)[0][0]
+        except Exception as e:
+            logging.error(e)
+            logging.error("wrong url", url)
+            return url
+    else:
+        return url
 
-    :param chat_id: id of chat channel
 
-    :param message_id: id of incoming message
+def picture_caption(p: GelbooruPicture, use_short_url=True):
+    """
+    resolve urls of a Gelbooru picture
 
     :param p: Gelbooru picture object
 
     :param use_short_url: Whether using short url for images. Default True.
 
-    :return: None
+    :return: (url of photo to send, caption text)
     """
-
-    def get_correct_url(url: str):
-        if url:
-            try:
-                return re.findall(r'((http|https)://.*)', url)[0][0]
-            except Exception as e:
-                logging.error(e)
-                logging.error("wrong url", url)
-                return url
-        else:
-            return url
-
-    # use regular expression in case of wrong url format
     url = get_correct_url(p.sample_url)
 
     # logging.info("id: {pic_id} - file_url: {file_url}".format(
@@ -203,7 +450,7 @@ def send_picture(
     # ))
 
     if use_short_url:
-        with ThreadPoolExecutor(max_workers=5) as executor:
+        with metrics.timer('send_picture.short_urls'), ThreadPoolExecutor(max_workers=5) as executor:
             view_url = executor.submit(
                 url2short,
                 'https://gelbooru.com/index.php?page=post&s=view&id=' + str(p.picture_id)
@@ -221,48 +468,179 @@ def send_picture(
             p.file_url, \
             'https://gelbooru.com/index.php?page=post&s=view&id=' + str(p.picture_id)
 
+    return url, PICTURE_INFO_TEXT.format(
+        rating=p.rating,
+        picture_id=p.picture_id,
+        view_url=view_url,
+        width=p.width,
+        height=p.height,
+        file_url=file_url,
+    )
+
+
+def send_picture(
+        bot: telegram.bot.Bot,
+        chat_id,
+        message_id,
+        p: GelbooruPicture,
+        use_short_url=True
+):
+    """
+    Used to send Gelbooru picture
+
+    :param bot: Telegrambot object
+
+    :param chat_id: id of chat channel
+
+    :param message_id: id of incoming message
+
+    :param p: Gelbooru picture object
+
+    :param use_short_url: Whether using short url for images. Default True.
+
+    :return: None
+    """
+    url, caption = picture_caption(p, use_short_url)
     recent_picture_id_caches[chat_id].add(p.picture_id)
     bot.send_photo(
         chat_id=chat_id,
         reply_to_message_id=message_id,
         photo=url,
-        caption=PICTURE_INFO_TEXT.format(
-            rating=p.rating,
-            picture_id=p.picture_id,
-            view_url=view_url,
-            width=p.width,
-            height=p.height,
-            file_url=file_url,
-        ),
+        caption=caption,
         reply_markup=ReplyKeyboardRemove()
     )
 
 
-def send_tags_info(bot: telegram.bot.Bot, update: telegram.Update, pic_id):
-    message_id = update.message.message_id
-    chat_id = update.message.chat_id
+def send_picture_group(bot: telegram.bot.Bot, chat_id, message_id, pages, count, safe_mode=False):
+    """
+    Send up to count pictures not yet seen in chat as one media group, or as a single photo
+    if only one is found, since a media group needs at least 2 items.
+    Seen pictures are tested one page at a time, stopping once enough are found,
+    captions are resolved concurrently, and chosen ones are marked seen in one round trip once sent.
 
-    bot.send_chat_action(chat_id=chat_id, action=telegram.ChatAction.TYPING)
-    picture = gelbooru_viewer.get(id=pic_id)
+    :param pages: iterable of lists of candidate Gelbooru pictures, in preferred order
 
-    if is_public_chat(update):
-        fetch_method = '/img'
-    else:
-        fetch_method = '/taxi'
+    :param count: max number of pictures to send
+
+    :return: number of pictures sent
+    """
+    seen_set = picture_chat_id_dic[chat_id]
+    chosen = []
+    chosen_ids = set()
+    for page in pages:
+        candidates = [p for p in page if (not safe_mode or p.rating == 's') and p.picture_id not in chosen_ids]
+        seen = seen_set.contains_many([p.picture_id for p in candidates])
+        for p, is_seen in zip(candidates, seen):
+            if not is_seen and len(chosen) < count:
+                chosen.append(p)
+                chosen_ids.add(p.picture_id)
+        if len(chosen) >= count:
+            break
+    if not chosen:
+        return 0
+    if len(chosen) == 1:
+        send_picture(bot, chat_id, message_id, chosen[0])
+        seen_set.add(chosen[0].picture_id)
+        return 1
+
+    with metrics.timer('send_picture_group.captions'), ThreadPoolExecutor(max_workers=len(chosen)) as executor:
+        captions = list(executor.map(picture_caption, chosen))
+    for p in chosen:
+        recent_picture_id_caches[chat_id].add(p.picture_id)
+    bot.send_media_group(
+        chat_id=chat_id,
+        reply_to_message_id=message_id,
+        media=[InputMediaPhoto(media=url, caption=caption) for url, caption in captions]
+    )
+    seen_set.add_many([p.picture_id for p in chosen])
+    return len(chosen)
+
+
+def parse_count(args):
+    """
+    split the picture count from args like /img 5 tags.
+    A first argument of digits followed by other arguments is the count, so /img 5 123 sends
+    5 pictures tagged 123. A numeric tag is searched after a count, as /img 1 123, or after another tag.
+    A single number is a picture id, and is not passed here.
+
+    :return: (count, remaining args)
+    """
+    if len(args) > 1 and args[0].isdigit():
+        return max(1, min(int(args[0]), MAX_MEDIA_GROUP_SIZE)), args[1:]
+    return 1, args
+
+
+def tag_reply_key(pic_id, fetch_method):
+    # ids arrive as str from commands and may be int or str on pictures, so both paths use int
+    return int(pic_id), fetch_method
+
+
+def render_tags_info(picture, fetch_method):
+    """
+    render tags of picture as text and a keyboard of fetch_method commands, cached per picture
 
-    if picture:
+    :return: (text, reply_markup)
+    """
+    key = tag_reply_key(picture.picture_id, fetch_method)
+    reply = tag_replies.get(key)
+    if reply is None:
         col = 3
-        picture = picture[0]
         buttons = [KeyboardButton("{} {}".format(fetch_method, tag)) for tag in picture.tags]
         reply_markup = ReplyKeyboardMarkup(
             [buttons[i:i + col] for i in range(0, len(buttons), col)],
             one_time_keyboard=True,
             resize_keyboard=True
         )
+        reply = tag_replies[key] = (", ".join(picture.tags), reply_markup)
+    return reply
+
+
+def reply_when_unavailable(func):
+    """
+    Decorator to tell the chat to try again later when Gelbooru is unavailable,
+    instead of leaving the command unanswered
+    """
+
+    @wraps(func)
+    def decorated_func(bot: telegram.bot.Bot, update: telegram.Update, *args, **kwargs):
+        try:
+            return func(bot, update, *args, **kwargs)
+        except Unavailable as e:
+            logging.warning(e)
+            bot.send_message(
+                chat_id=update.message.chat_id,
+                reply_to_message_id=update.message.message_id,
+                text=UNAVAILABLE_TEXT
+            )
+
+    return decorated_func
+
+
+@reply_when_unavailable
+def send_tags_info(bot: telegram.bot.Bot, update: telegram.Update, pic_id):
+    message_id = update.message.message_id
+    chat_id = update.message.chat_id
+
+    if is_public_chat(update):
+        fetch_method = '/img'
+    else:
+        fetch_method = '/taxi'
+
+    # rendered replies are cached, so repeated lookups neither fetch the picture nor rebuild keyboards
+    reply = tag_replies.get(tag_reply_key(pic_id, fetch_method))
+    metrics.hit('tag_replies', reply is not None)
+    if reply is None:
+        bot.send_chat_action(chat_id=chat_id, action=telegram.ChatAction.TYPING)
+        picture = get_picture(pic_id)
+        if picture:
+            reply = render_tags_info(picture[0], fetch_method)
+
+    if reply:
+        text, reply_markup = reply
         bot.send_message(
             chat_id=chat_id,
             reply_to_message_id=message_id,
-            text=", ".join(picture.tags),
+            text=text,
             reply_markup=reply_markup
         )
     else:
@@ -273,6 +651,7 @@ def send_tags_info(bot: telegram.bot.Bot, update: telegram.Update, pic_id):
         )
 
 
+@reply_when_unavailable
 def send_gelbooru_images(bot: telegram.bot.Bot, update: telegram.Update, args, safe_mode=False):
     """
     implement send gelbooru images with args to Telegram chat
@@ -286,9 +665,9 @@ def send_gelbooru_images(bot: telegram.bot.Bot, update: telegram.Update, args, s
 
     if args:
         # fetch picture_id = args[0] of it is digits
-        if args[0].isdigit():
+        if len(args) == 1 and args[0].isdigit():
             bot.send_chat_action(chat_id=chat_id, action=telegram.ChatAction.UPLOAD_PHOTO)
-            picture = gelbooru_viewer.get(id=args[0])
+            picture = get_picture(args[0])
             if picture:
                 picture = picture[0]
                 picture_chat_id_dic[chat_id].add(picture.picture_id)
@@ -302,22 +681,46 @@ def send_gelbooru_images(bot: telegram.bot.Bot, update: telegram.Update, args, s
             return
         # fetch picture_tags = args
         else:
+            count, args = parse_count(args)
             bot.send_chat_action(chat_id=chat_id, action=telegram.ChatAction.UPLOAD_PHOTO)
-            pictures = gelbooru_viewer.get_all(tags=args, num=200, limit=10, thread_limit=1)
-            if pictures:
-                for pic in pictures:
-                    if picture_chat_id_dic[chat_id].add(pic.picture_id) == 1:
-                        if safe_mode and pic.rating != 's':
-                            continue
-                        send_picture(bot, chat_id, message_id, pic)
-                        break
-                else:
+            if count > 1 and send_picture_group(
+                    bot, chat_id, message_id, stream_pictures(args), count, safe_mode
+            ):
+                return
+            found = False
+            candidates = []  # pictures seen already, sent again if all are
+            # the first unseen picture is sent as soon as its page arrives
+            for pic in chain.from_iterable(stream_pictures(args)):
+                found = True
+                if picture_chat_id_dic[chat_id].add(pic.picture_id) == 1:
+                    if safe_mode and pic.rating != 's':
+                        continue
+                    send_picture(bot, chat_id, message_id, pic)
+                    break
+                if not safe_mode or pic.rating == 's':
+                    candidates.append(pic)
+            else:
+                seen_set = picture_chat_id_dic[chat_id]
+                if found and isinstance(seen_set, redis_dao.RedisTimedSet):
+                    # the window holds pictures of other tags too, so instead of clearing it,
+                    # the picture seen longest ago is sent again
+                    pic_id = seen_set.refresh_oldest([p.picture_id for p in candidates])
+                    if pic_id is not None:
+                        picture = next(p for p in candidates if p.picture_id == pic_id)
+                        send_picture(bot, chat_id, message_id, picture)
+                    else:
+                        bot.send_message(
+                            chat_id=chat_id,
+                            reply_to_message_id=message_id,
+                            text="No image with these tags is SFW"
+                        )
+                elif found:
                     bot.send_chat_action(chat_id=chat_id, action=telegram.ChatAction.UPLOAD_PHOTO)
                     # get picture from redis server
                     pic_id = picture_chat_id_dic[chat_id].pop()
                     # get safe picture if safe_mode is True
                     while pic_id:
-                        picture = gelbooru_viewer.get(id=pic_id)[0]
+                        picture = get_picture(pic_id)[0]
                         if not safe_mode or picture.rating == 's':
                             picture_chat_id_dic[chat_id].add(pic_id)
                             send_picture(bot, chat_id, message_id, picture)
@@ -333,18 +736,19 @@ def send_gelbooru_images(bot: telegram.bot.Bot, update: telegram.Update, args, s
                             reply_to_message_id=message_id,
                             text="No image with these tags is SFW"
                         )
-
-            else:
-                bot.send_message(
-                    chat_id=chat_id,
-                    reply_to_message_id=message_id,
-                    text="Tag: {tags} not found".format(tags=args)
-                )
+                else:
+                    text, reply_markup = tags_not_found_reply(args, '/img' if safe_mode else '/taxi')
+                    bot.send_message(
+                        chat_id=chat_id,
+                        reply_to_message_id=message_id,
+                        text=text,
+                        reply_markup=reply_markup
+                    )
     else:
         # send random picture
         bot.send_chat_action(chat_id=chat_id, action=telegram.ChatAction.UPLOAD_PHOTO)
         # fetch latest picture
-        picture = gelbooru_viewer.get(limit=1)
+        picture = get_latest_picture()
         if ((not safe_mode) and picture_chat_id_dic[chat_id].add(picture[0].picture_id) == 0) or \
                 (safe_mode and picture[0].rating != 's'):
             while True:
@@ -354,7 +758,7 @@ def send_gelbooru_images(bot: telegram.bot.Bot, update: telegram.Update, args, s
                     if picture_chat_id_dic[chat_id].add(pic_id) == 1:
                         break
 
-                picture = gelbooru_viewer.get(id=pic_id)
+                picture = get_picture(pic_id)
                 if picture:
                     if (not safe_mode) or picture[0].rating == 's':
                         # picture found (and SFW if safe_mode is on), then stop loop
@@ -369,17 +773,17 @@ def send_gelbooru_images(bot: telegram.bot.Bot, update: telegram.Update, args, s
         send_picture(bot, chat_id, message_id, picture)
 
 
-@set_command_handler('img', pass_args=True)
-@run_async
+@set_command_handler('img', pass_args=True, lane='io')
+@reply_when_unavailable
 def send_safe_gelbooru_images(bot: telegram.bot.Bot, update: telegram.Update, args):
     chat_id = update.message.chat_id
     message_id = update.message.message_id
 
     bot.send_chat_action(chat_id=chat_id, action=telegram.ChatAction.TYPING)
     # Todo correctly implement cache routine using redis
-    if args and args[0].isdigit():
+    if len(args) == 1 and args[0].isdigit():
         bot.send_chat_action(chat_id=chat_id, action=telegram.ChatAction.UPLOAD_PHOTO)
-        picture = gelbooru_viewer.get(id=args[0])
+        picture = get_picture(args[0])
         if picture:
             picture = picture[0]
             if picture.rating != 's':
@@ -402,8 +806,7 @@ def send_safe_gelbooru_images(bot: telegram.bot.Bot, update: telegram.Update, ar
         send_gelbooru_images(bot, update, args, safe_mode=True)
 
 
-@set_command_handler('taxi', pass_args=True)
-@run_async
+@set_command_handler('taxi', pass_args=True, lane='io')
 def send_taxi_images(bot: telegram.bot.Bot, update: telegram.Update, args):
     chat_id = update.message.chat_id
     message_id = update.message.message_id
@@ -420,8 +823,7 @@ def send_taxi_images(bot: telegram.bot.Bot, update: telegram.Update, args):
     send_gelbooru_images(bot, update, args)
 
 
-@set_command_handler('tag', pass_args=True)
-@run_async
+@set_command_handler('tag', pass_args=True, lane='io')
 def tag_id(bot: telegram.Bot, update: telegram.Update, args):
     chat_id = update.message.chat_id
     message_id = update.message.message_id
@@ -0,0 +1,85 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class IdleDict:
+    def __init__(self, factory, max_size=10000, idle_timeout=3600., on_evict=None):
+        """
+        A dict of per-chat objects which only holds recently used keys.
+        Missing keys are created by factory(key). Keys unused for idle_timeout seconds,
+        and least recently used keys beyond max_size, are evicted on later accesses,
+        calling on_evict(key, value) to write back what needs persisting.
+        It is threading-safe.
+
+        :param factory: function creating the value of a missing key, e.g. loading it from redis
+
+        :param max_size: max number of keys held
+
+        :param idle_timeout: seconds a key is kept without being used
+
+        :param on_evict: function called with (key, value) of every evicted key.
+        It is called with the lock held, so a key is never reloaded before it is written back.
+        """
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.on_evict = on_evict
+        self.data = OrderedDict()  # key -> [value, last used time], least recently used first
+        self.lock = threading.RLock()
+
+    def __getitem__(self, key):
+        with self.lock:
+            now = monotonic()
+            entry = self.data.get(key)
+            if entry is None:
+                entry = self.data[key] = [self.factory(key), now]
+                self.evict(now)
+            else:
+                entry[1] = now
+                self.data.move_to_end(key)
+            return entry[0]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        with self.lock:
+            return list(self.data)
+
+    def items(self):
+        with self.lock:
+            return [(key, entry[0]) for key, entry in self.data.items()]
+
+    def pop(self, key, *default):
+        with self.lock:
+            if key in self.data:
+                return self.data.pop(key)[0]
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def evict(self, now=None):
+        """
+        evict idle keys and keys beyond max_size
+
+        :return: number of keys evicted
+        """
+        evicted = 0
+        with self.lock:
+            now = monotonic() if now is None else now
+            while self.data:
+                key, (value, last_used) = next(iter(self.data.items()))
+                if len(self.data) <= self.max_size and now - last_used < self.idle_timeout:
+                    break
+                del self.data[key]
+                evicted += 1
+                if self.on_evict:
+                    self.on_evict(key, value)
+        return evicted
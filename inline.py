@@ -0,0 +1,108 @@
+import logging
+
+import telegram
+from telegram import InlineQueryResultPhoto
+from telegram.ext import InlineQueryHandler
+
+from gelbooru_commands import stream_pictures, get_correct_url, picture_caption
+from resilience import StaleCache, Unavailable
+from scheduler import run_latest
+from tag_index import normalize_query
+import metrics
+import profiling
+
+# Constants
+INLINE_HANDLERS = []
+PAGE_SIZE = 20  # results per answer, Telegram takes at most 50
+PAGE_FRESH_TIME = 60  # seconds a page is served without rebuilding it
+PAGE_MAX_STALE = 600  # seconds a page is served while rebuilding it in the background
+MAX_CACHED_PAGES = 2048
+INLINE_CACHE_TIME = 300  # seconds Telegram may cache an answer itself
+
+# (normalized query, offset) -> (results, next offset), shared by all users
+page_cache = StaleCache('inline_pages', MAX_CACHED_PAGES, PAGE_FRESH_TIME, PAGE_MAX_STALE)
+
+
+def set_inline_handler(pattern=None, lane=None):
+    """
+    register the decorated function as an inline query handler
+
+    :param lane: name of the executor lane in scheduler.LANES to run the handler on.
+    Only the latest query of a user waits there, older ones are dropped as the user types.
+    If None, the handler runs in the dispatcher thread.
+    """
+    def decorate(func):
+        name = 'inline.{}'.format(func.__name__)
+        callback = profiling.profiled(name)(metrics.timed(name)(func))
+        if lane:
+            callback = run_latest(callback, lane)
+        INLINE_HANDLERS.append(InlineQueryHandler(callback=callback, pattern=pattern))
+        return func
+
+    return decorate
+
+
+def build_page(tags, offset):
+    """
+    build a page of inline results of safe pictures with tags,
+    fetching search pages only until this one is filled
+
+    :return: (list of InlineQueryResultPhoto, next offset, '' if it is the last page)
+    """
+    pictures = []
+    pages = stream_pictures(tags)
+    try:
+        for page in pages:
+            # answers may be posted into any chat, so only safe pictures are offered
+            pictures.extend(p for p in page if p.rating == 's')
+            # one more than the page tells whether there is a next one
+            if len(pictures) > offset + PAGE_SIZE:
+                break
+    finally:
+        # pages fetched so far are cached for the next offsets
+        pages.close()
+    results = []
+    for p in pictures[offset:offset + PAGE_SIZE]:
+        url, caption = picture_caption(p, use_short_url=False)
+        results.append(InlineQueryResultPhoto(
+            id=str(p.picture_id),
+            photo_url=url,
+            thumb_url=get_correct_url(p.preview_url) or url,
+            photo_width=p.width,
+            photo_height=p.height,
+            caption=caption
+        ))
+    next_offset = str(offset + PAGE_SIZE) if offset + PAGE_SIZE < len(pictures) else ''
+    return results, next_offset
+
+
+def get_page(tags, offset):
+    return page_cache.get((normalize_query(tags), offset), lambda: build_page(tags, offset))
+
+
+@set_inline_handler(lane='io')
+def inline_pictures(bot: telegram.Bot, update: telegram.Update):
+    """
+    @bot tags: pick a safe picture with tags, PAGE_SIZE results at a time
+    """
+    query = update.inline_query
+    tags = query.query.split()
+    offset = int(query.offset) if query.offset.isdigit() else 0
+
+    if not tags:
+        results, next_offset = [], ''
+    else:
+        try:
+            results, next_offset = get_page(tags, offset)
+        except Unavailable as e:
+            logging.warning(e)
+            # answered anyway, so the client stops waiting, but not cached
+            bot.answer_inline_query(query.id, [], cache_time=0)
+            return
+    bot.answer_inline_query(
+        query.id,
+        results,
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=False,
+        next_offset=next_offset
+    )
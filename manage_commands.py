@@ -1,4 +1,49 @@
-from commands import set_command_handler, run_async
+import telegram
 
+from commands import set_command_handler
+import config
+import profiling
 
-# Todo implement block/unblock, addAdmin/delAdmin functions, and corresponding data structure like admins, owner.
\ No newline at end of file
+
+def is_admin(update: telegram.Update):
+    user = update.effective_user
+    return bool(user) and user.id in config.ADMIN_IDS
+
+
+# Todo implement block/unblock, addAdmin/delAdmin functions, and corresponding data structure like admins, owner.
+
+
+@set_command_handler('profile', pass_args=True, lane='io')
+def profile(bot: telegram.Bot, update: telegram.Update, args):
+    """
+    /profile <handler> [calls] [cpu|mem|all]: profile the next calls of a handler.
+    handler is a command name like img, or a metrics name like message.photo_record.
+    """
+    chat_id = update.message.chat_id
+    message_id = update.message.message_id
+
+    if not is_admin(update):
+        return
+    if not args or (len(args) > 1 and not args[1].isdigit()) or (len(args) > 2 and args[2] not in profiling.MODES):
+        bot.send_message(
+            chat_id=chat_id,
+            reply_to_message_id=message_id,
+            text="Usage: /profile <handler> [calls] [{}]".format('|'.join(profiling.MODES))
+        )
+        return
+
+    name = args[0] if '.' in args[0] else 'command.' + args[0]
+    calls = int(args[1]) if len(args) > 1 else 10
+    mode = args[2] if len(args) > 2 else 'cpu'
+    try:
+        profiling.arm(name, calls, mode)
+    except ValueError as e:
+        bot.send_message(chat_id=chat_id, reply_to_message_id=message_id, text=str(e))
+        return
+    bot.send_message(
+        chat_id=chat_id,
+        reply_to_message_id=message_id,
+        text="Profiling {} ({}) for the next {} calls, results go to {}".format(
+            name, mode, calls, profiling.PROFILE_DIR
+        )
+    )
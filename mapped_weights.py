@@ -0,0 +1,127 @@
+"""
+Store a model object as a pickle plus one .npy file per weight array, and load it back
+with the arrays memory-mapped read-only. Every process loading it shares one copy of the
+weights in the page cache, and loading takes no more than reading the pickle.
+"""
+import json
+import logging
+import os
+import pickle
+import shutil
+
+import numpy
+
+# Constants
+FORMAT_VERSION = 1
+MIN_MAPPED_SIZE = 4096  # bytes, smaller arrays are kept in the pickle
+OBJECT_FILE_NAME = 'object.pickle'
+MANIFEST_FILE_NAME = 'manifest.json'
+
+
+class ArrayPickler(pickle.Pickler):
+    def __init__(self, fp, directory):
+        """
+        Pickler saving numeric ndarrays to .npy files in directory instead of into the pickle
+        """
+        super().__init__(fp, protocol=pickle.HIGHEST_PROTOCOL)
+        self.directory = directory
+        self.saved = {}  # id of array -> (array, file name), so a shared array is saved once
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, numpy.ndarray) or obj.dtype.hasobject or obj.nbytes < MIN_MAPPED_SIZE:
+            return None
+        if id(obj) not in self.saved:
+            file_name = 'array_{}.npy'.format(len(self.saved))
+            numpy.save(os.path.join(self.directory, file_name), numpy.ascontiguousarray(obj))
+            self.saved[id(obj)] = (obj, file_name)
+        return self.saved[id(obj)][1]
+
+
+class ArrayUnpickler(pickle.Unpickler):
+    def __init__(self, fp, directory):
+        super().__init__(fp)
+        self.directory = directory
+        self.loaded = {}  # file name -> array, so a shared array is mapped once
+
+    def persistent_load(self, pid):
+        if pid not in self.loaded:
+            self.loaded[pid] = numpy.load(os.path.join(self.directory, pid), mmap_mode='r')
+        return self.loaded[pid]
+
+
+def source_mtime(source):
+    try:
+        return os.path.getmtime(source) if source else None
+    except OSError:
+        return None
+
+
+def is_current(directory, source=None):
+    """
+    :return: True if directory holds a converted object at least as new as source
+    """
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE_NAME), 'r') as fp:
+            manifest = json.load(fp)
+    except (OSError, ValueError):
+        return False
+    return manifest.get('version') == FORMAT_VERSION and manifest.get('source_mtime') == source_mtime(source)
+
+
+def dump(obj, directory, source=None):
+    """
+    convert obj into directory, replacing a previous conversion
+
+    :param source: file obj was built from, recorded to convert again when it changes
+    """
+    tmp_directory = '{}.{}.tmp'.format(directory, os.getpid())
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    try:
+        with open(os.path.join(tmp_directory, OBJECT_FILE_NAME), 'wb') as fp:
+            ArrayPickler(fp, tmp_directory).dump(obj)
+        with open(os.path.join(tmp_directory, MANIFEST_FILE_NAME), 'w') as fp:
+            json.dump({'version': FORMAT_VERSION, 'source_mtime': source_mtime(source)}, fp)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.rename(tmp_directory, directory)
+    except OSError:
+        # another process converted it at the same time
+        if not is_current(directory, source):
+            raise
+    finally:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+
+
+def load(directory):
+    """
+    :return: object converted into directory, with weight arrays memory-mapped read-only
+    """
+    with open(os.path.join(directory, OBJECT_FILE_NAME), 'rb') as fp:
+        return ArrayUnpickler(fp, directory).load()
+
+
+def load_or_convert(directory, factory, source=None):
+    """
+    load the object converted into directory, converting it first if missing or older than source
+
+    :param directory: directory of the converted object
+
+    :param factory: function constructing the object the normal way
+
+    :param source: file the object is built from, like a .h5 of weights
+
+    :return: object, with weights memory-mapped unless conversion failed
+    """
+    if is_current(directory, source):
+        try:
+            return load(directory)
+        except Exception as e:
+            logging.warning("loading {} failed, converting it again: {}".format(directory, e))
+    obj = factory()
+    try:
+        dump(obj, directory, source)
+        # map the converted arrays, so the ones just built are freed
+        return load(directory)
+    except Exception as e:
+        logging.warning("converting to {} failed, keeping weights in memory: {}".format(directory, e))
+        return obj
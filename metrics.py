@@ -0,0 +1,223 @@
+import logging
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread, Event
+from time import perf_counter
+
+# Constants
+SAMPLE_SIZE = 1024  # latest samples of a timing kept for percentiles
+PERCENTILES = (0.5, 0.9, 0.99)
+
+logger = logging.getLogger('metrics')
+logger.setLevel(logging.INFO)
+
+
+class Timing:
+    def __init__(self, sample_size=SAMPLE_SIZE):
+        """
+        Statistics of a timed stage. Percentiles are computed over the latest sample_size samples,
+        count, total and max over all samples.
+
+        :param sample_size: number of latest samples kept
+        """
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.samples = deque(maxlen=sample_size)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def percentile(self, p):
+        samples = sorted(self.samples)
+        if not samples:
+            return 0.
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+
+lock = Lock()
+timings = defaultdict(Timing)  # name -> Timing
+counters = defaultdict(int)  # name -> count
+gauges = {}  # name -> function returning current value
+
+
+def observe(name, seconds):
+    with lock:
+        timings[name].add(seconds)
+
+
+def incr(name, n=1):
+    with lock:
+        counters[name] += n
+
+
+def hit(name, is_hit):
+    """
+    count a cache lookup of cache name
+    """
+    incr(name + ('.hit' if is_hit else '.miss'))
+
+
+def reset():
+    """
+    clear timings and counters, gauges are kept
+    """
+    with lock:
+        timings.clear()
+        counters.clear()
+
+
+def register_gauge(name, func):
+    gauges[name] = func
+
+
+@contextmanager
+def timer(name):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, perf_counter() - start)
+
+
+def timed(name):
+    """
+    Decorator to time every call of the decorated function as name
+    """
+
+    def decorate(func):
+        @wraps(func)
+        def timed_func(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+
+        return timed_func
+
+    return decorate
+
+
+def snapshot():
+    """
+    :return: (timings, counters, gauges), copies of current values.
+    timings maps name to (count, total, max, {percentile: seconds})
+    """
+    with lock:
+        timing_values = {
+            name: (t.count, t.total, t.max, {p: t.percentile(p) for p in PERCENTILES})
+            for name, t in timings.items()
+        }
+        counter_values = dict(counters)
+    gauge_values = {}
+    for name, func in list(gauges.items()):
+        try:
+            gauge_values[name] = func()
+        except Exception as e:
+            logger.error("gauge {} failed: {}".format(name, e))
+    return timing_values, counter_values, gauge_values
+
+
+def render():
+    """
+    :return: metrics in Prometheus text format
+    """
+    timing_values, counter_values, gauge_values = snapshot()
+    lines = []
+    for name, (count, total, max_seconds, percentiles) in sorted(timing_values.items()):
+        for p, seconds in percentiles.items():
+            lines.append('bot_timing_seconds{{name="{}",quantile="{}"}} {:.6f}'.format(name, p, seconds))
+        lines.append('bot_timing_seconds_max{{name="{}"}} {:.6f}'.format(name, max_seconds))
+        lines.append('bot_timing_seconds_sum{{name="{}"}} {:.6f}'.format(name, total))
+        lines.append('bot_timing_seconds_count{{name="{}"}} {}'.format(name, count))
+    for name, value in sorted(counter_values.items()):
+        lines.append('bot_counter{{name="{}"}} {}'.format(name, value))
+    for name, value in sorted(gauge_values.items()):
+        lines.append('bot_gauge{{name="{}"}} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+
+def summary():
+    """
+    :return: human readable summary of metrics
+    """
+    timing_values, counter_values, gauge_values = snapshot()
+    lines = []
+    for name, (count, total, max_seconds, percentiles) in sorted(timing_values.items()):
+        lines.append("{}: n={} mean={:.1f}ms {} max={:.1f}ms".format(
+            name,
+            count,
+            1000 * total / count if count else 0.,
+            ' '.join("p{:g}={:.1f}ms".format(100 * p, 1000 * s) for p, s in percentiles.items()),
+            1000 * max_seconds
+        ))
+    # hit rates of caches counted by hit()
+    for name in sorted(n[:-4] for n in counter_values if n.endswith('.hit')):
+        hits, misses = counter_values[name + '.hit'], counter_values.get(name + '.miss', 0)
+        lines.append("{}: hit rate {:.1%} of {}".format(name, hits / (hits + misses), hits + misses))
+    for name, value in sorted(counter_values.items()):
+        if not name.endswith(('.hit', '.miss')):
+            lines.append("{}: {}".format(name, value))
+    for name, value in sorted(gauge_values.items()):
+        lines.append("{}: {}".format(name, value))
+    return '\n'.join(lines)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = render().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/summary':
+            body = summary().encode('utf-8')
+            content_type = 'text/plain; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def log_summary_forever(interval, stopped: Event):
+    while not stopped.wait(interval):
+        logger.info("metrics summary\n" + summary())
+
+
+def start(listen='127.0.0.1', port=0, summary_interval=0):
+    """
+    serve metrics on http://listen:port/metrics and /summary, and log a summary periodically
+
+    :param listen: host to listen on
+
+    :param port: port to listen on. The endpoint is not started if 0.
+
+    :param summary_interval: seconds between summary logs. No summary is logged if 0.
+
+    :return: Event which stops summary logs when set
+    """
+    if port:
+        server = MetricsServer((listen, port), MetricsRequestHandler)
+        Thread(target=server.serve_forever, name='metrics_server', daemon=True).start()
+    stopped = Event()
+    if summary_interval:
+        Thread(
+            target=log_summary_forever,
+            args=(summary_interval, stopped),
+            name='metrics_summary',
+            daemon=True
+        ).start()
+    return stopped
@@ -0,0 +1,125 @@
+import logging
+from threading import Lock
+from time import monotonic, sleep
+
+import telegram
+from telegram.error import RetryAfter
+from lru import LRU
+
+import metrics
+
+# Constants
+GLOBAL_RATE = 30.  # messages per second for all chats
+PRIVATE_CHAT_RATE = 1.  # messages per second in a private chat
+GROUP_CHAT_RATE = 20. / 60  # messages per second in a group chat
+CHAT_BURST = 3  # messages allowed back to back before a chat is paced
+CHAT_ACTION_LIFETIME = 5.  # seconds a chat action stays visible on Telegram clients
+MAX_RETRIES = 3  # retries of a request rejected by flood control
+MAX_TRACKED_CHATS = 4096  # chats whose limiter and last action are kept
+
+
+class RateLimiter:
+    def __init__(self, rate, burst=1):
+        """
+        Pace calls to at most rate per second, allowing burst calls back to back.
+        It is threading-safe.
+
+        :param rate: calls per second
+
+        :param burst: calls allowed without waiting after an idle period
+        """
+        self.interval = 1. / rate
+        self.burst = burst
+        self.next_time = 0.
+        self.lock = Lock()
+
+    def acquire(self):
+        """
+        block until a call is allowed
+
+        :return: seconds waited
+        """
+        with self.lock:
+            now = monotonic()
+            start = max(self.next_time, now - (self.burst - 1) * self.interval)
+            self.next_time = start + self.interval
+        delay = start - now
+        if delay > 0:
+            sleep(delay)
+            return delay
+        return 0.
+
+
+class ThrottledBot(telegram.Bot):
+    """
+    telegram.Bot which paces outbound messages by global and per-chat rate limits,
+    drops chat actions that are still visible, and retries on flood control.
+    """
+
+    def __init__(self, *args, global_rate=GLOBAL_RATE, **kwargs):
+        """
+        :param global_rate: messages per second for all chats of this bot.
+        Bots sharing a token should share GLOBAL_RATE between them.
+        """
+        super().__init__(*args, **kwargs)
+        self.global_limiter = RateLimiter(global_rate, burst=max(1, int(global_rate)))
+        self.chat_limiters = LRU(MAX_TRACKED_CHATS)
+        self.chat_limiters_lock = Lock()
+        self.chat_actions = LRU(MAX_TRACKED_CHATS)  # chat_id -> (action, sent time)
+
+    def get_chat_limiter(self, chat_id):
+        with self.chat_limiters_lock:
+            limiter = self.chat_limiters.get(chat_id)
+            if limiter is None:
+                try:
+                    is_group = int(chat_id) < 0
+                except (TypeError, ValueError):
+                    # channel username
+                    is_group = True
+                limiter = RateLimiter(GROUP_CHAT_RATE if is_group else PRIVATE_CHAT_RATE, burst=CHAT_BURST)
+                self.chat_limiters[chat_id] = limiter
+            return limiter
+
+    def call_with_retry(self, method, *args, **kwargs):
+        for retry in range(MAX_RETRIES + 1):
+            try:
+                return method(*args, **kwargs)
+            except RetryAfter as e:
+                metrics.incr('telegram.retry_after')
+                if retry == MAX_RETRIES:
+                    raise
+                logging.warning("flood control on {}, retry in {}s".format(method.__name__, e.retry_after))
+                sleep(e.retry_after)
+
+    def send_throttled(self, method, *args, **kwargs):
+        chat_id = kwargs['chat_id'] if 'chat_id' in kwargs else args[0]
+        waited = self.get_chat_limiter(chat_id).acquire() + self.global_limiter.acquire()
+        metrics.observe('telegram.throttle_wait', waited)
+        with metrics.timer('telegram.{}'.format(method.__name__)):
+            result = self.call_with_retry(method, *args, **kwargs)
+        # a sent message ends the chat action on clients
+        self.chat_actions.pop(chat_id, None)
+        return result
+
+    def send_message(self, *args, **kwargs):
+        return self.send_throttled(super().send_message, *args, **kwargs)
+
+    def send_photo(self, *args, **kwargs):
+        return self.send_throttled(super().send_photo, *args, **kwargs)
+
+    def send_document(self, *args, **kwargs):
+        return self.send_throttled(super().send_document, *args, **kwargs)
+
+    def send_media_group(self, *args, **kwargs):
+        return self.send_throttled(super().send_media_group, *args, **kwargs)
+
+    def send_chat_action(self, chat_id, action, *args, **kwargs):
+        last = self.chat_actions.get(chat_id)
+        now = monotonic()
+        if last and last[0] == action and now - last[1] < CHAT_ACTION_LIFETIME:
+            metrics.incr('telegram.chat_action.coalesced')
+            return True
+        self.chat_actions[chat_id] = (action, now)
+        self.global_limiter.acquire()
+        metrics.incr('telegram.chat_action.sent')
+        return self.call_with_retry(super().send_chat_action, chat_id, action, *args, **kwargs)
@@ -0,0 +1,164 @@
+import cProfile
+import logging
+import os
+import pstats
+import tracemalloc
+from functools import wraps
+from threading import Lock
+from time import strftime
+
+import metrics
+
+# Constants
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+MODES = ('cpu', 'mem', 'all')
+TOP_MEMORY_DIFFS = 30  # lines of memory growth written per session
+
+lock = Lock()
+sessions = {}  # handler name -> ProfileSession armed for it
+handlers = set()  # names of handlers which can be profiled
+tracing_users = 0  # sessions tracing memory allocations
+started_tracing = False  # True if tracemalloc was started by this module
+
+
+def start_tracing():
+    """
+    start tracemalloc for a session, if not tracing yet
+    """
+    global tracing_users, started_tracing
+    with lock:
+        if not tracing_users and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+        tracing_users += 1
+
+
+def stop_tracing():
+    """
+    release tracemalloc of a session, stopping it when no other session traces and this module started it
+    """
+    global tracing_users, started_tracing
+    with lock:
+        tracing_users -= 1
+        if not tracing_users and started_tracing:
+            tracemalloc.stop()
+            started_tracing = False
+
+
+class ProfileSession:
+    def __init__(self, name, calls, mode='cpu'):
+        """
+        Profile the next calls of handler name.
+        'cpu' merges deterministic profiles of every call into one pstats file,
+        'mem' writes the memory growth and the change of metrics gauges over the calls,
+        'all' does both.
+
+        :param name: handler name, as timed in metrics, e.g. command.img
+
+        :param calls: number of calls to profile
+
+        :param mode: one of MODES
+        """
+        self.name = name
+        self.remaining = calls
+        self.mode = mode
+        self.stats = None
+        self.lock = Lock()
+        self.snapshot = None
+        self.gauges = None
+        if mode in ('mem', 'all'):
+            start_tracing()
+            self.snapshot = tracemalloc.take_snapshot()
+            self.gauges = metrics.snapshot()[2]
+
+    def run(self, func, *args, **kwargs):
+        # a profiler only sees its own thread, so every call gets one
+        profile = cProfile.Profile() if self.mode in ('cpu', 'all') else None
+        try:
+            if profile:
+                return profile.runcall(func, *args, **kwargs)
+            return func(*args, **kwargs)
+        finally:
+            with self.lock:
+                if profile:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profile)
+                    else:
+                        self.stats.add(profile)
+                self.remaining -= 1
+                finished = self.remaining == 0
+            if finished:
+                self.finish()
+
+    def cancel(self):
+        """
+        drop a session replaced before its calls are done, without writing results
+        """
+        with self.lock:
+            finished = self.remaining <= 0
+            self.remaining = 0
+        if not finished and self.snapshot is not None:
+            stop_tracing()
+
+    def finish(self):
+        with lock:
+            if sessions.get(self.name) is self:
+                del sessions[self.name]
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, "{}-{}".format(self.name, strftime('%Y%m%d-%H%M%S')))
+
+        if self.stats is not None:
+            self.stats.dump_stats(path + '.prof')
+        if self.snapshot is not None:
+            diffs = tracemalloc.take_snapshot().compare_to(self.snapshot, 'lineno')
+            gauges = metrics.snapshot()[2]
+            stop_tracing()
+            with open(path + '.memory.txt', 'w') as fp:
+                fp.write("gauges (before -> after):\n")
+                for name in sorted(gauges):
+                    fp.write("{}: {} -> {}\n".format(name, self.gauges.get(name), gauges[name]))
+                fp.write("\ntop {} memory growth:\n".format(TOP_MEMORY_DIFFS))
+                for diff in diffs[:TOP_MEMORY_DIFFS]:
+                    fp.write("{}\n".format(diff))
+        logging.getLogger('metrics').info("profile of {} written to {}.*".format(self.name, path))
+
+
+def arm(name, calls=10, mode='cpu'):
+    """
+    profile the next calls of handler name, replacing a session already armed for it
+
+    :return: ProfileSession
+
+    :raise ValueError: if name is not a profiled handler or mode is not in MODES
+    """
+    if mode not in MODES:
+        raise ValueError("mode should be one of {}".format(', '.join(MODES)))
+    if name not in handlers:
+        raise ValueError("no handler named {}".format(name))
+    session = ProfileSession(name, calls, mode)
+    with lock:
+        replaced = sessions.get(name)
+        sessions[name] = session
+    if replaced is not None:
+        replaced.cancel()
+    return session
+
+
+def profiled(name):
+    """
+    Decorator to let handler name be profiled when a session is armed for it
+    """
+
+    handlers.add(name)
+
+    def decorate(func):
+        @wraps(func)
+        def profiled_func(*args, **kwargs):
+            session = sessions.get(name)
+            if session is None:
+                return func(*args, **kwargs)
+            return session.run(func, *args, **kwargs)
+
+        return profiled_func
+
+    return decorate
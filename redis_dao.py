@@ -1,8 +1,9 @@
-import os
-import subprocess
-from collections import defaultdict
 import redis
 import pickle
+from time import time
+
+import metrics
+from idle_dict import IdleDict
 
 
 class RedisDAO:
@@ -17,9 +18,6 @@ class RedisDAO:
         self.port = port
         self.conn = redis.Redis(host=host, port=port, *args, **kwargs)
 
-        # auto start redis server when server is not set-up yet.
-        self.ping()
-
     @staticmethod
     def __valueEncode__(value):
         if not value or isinstance(value, (int, float, str)):
@@ -45,12 +43,12 @@ class RedisDAO:
         return bool(self.conn.get(self.__valueEncode__(item)))
 
     def ping(self):
+        """
+        :return: True if redis server is up. Servers are started by redis_supervisor.
+        """
         try:
             return self.conn.ping()
         except redis.exceptions.ConnectionError:
-            subprocess.Popen(["setsid", "redis-server", '--bind', self.host, '--port', str(self.port)],
-                             stdout=open(os.devnull, "w"),
-                             stderr=subprocess.STDOUT)
             return False
 
 
@@ -58,18 +56,46 @@ class RedisDAO:
 
 
 class RedisSet(RedisDAO):
+    @metrics.timed('redis.set.add')
     def add(self, value):
         return int(self.conn.sadd(self.name, self.__valueEncode__(value)))
 
+    @metrics.timed('redis.set.add_many')
+    def add_many(self, values):
+        """
+        add values in one round trip
+
+        :return: list of 1 for each value newly added, 0 for each already in set
+        """
+        pipe = self.conn.pipeline(transaction=False)
+        for value in values:
+            pipe.sadd(self.name, self.__valueEncode__(value))
+        return [int(added) for added in pipe.execute()]
+
+    @metrics.timed('redis.set.contains_many')
+    def contains_many(self, values):
+        """
+        test values for membership in one round trip
+
+        :return: list of bool
+        """
+        pipe = self.conn.pipeline(transaction=False)
+        for value in values:
+            pipe.sismember(self.name, self.__valueEncode__(value))
+        return [bool(member) for member in pipe.execute()]
+
+    @metrics.timed('redis.set.pop')
     def pop(self):
         return self.__valueDecode__(self.conn.spop(self.name))
 
+    @metrics.timed('redis.set.remove')
     def remove(self, value):
         return int(self.conn.srem(self.name, self.__valueEncode__(value)))
 
     def items(self):
         return {self.__valueDecode__(_) for _ in self.conn.smembers(self.name)}
 
+    @metrics.timed('redis.set.contains')
     def __contains__(self, item):
         return bool(self.conn.sismember(self.name, self.__valueEncode__(item)))
 
@@ -80,9 +106,145 @@ class RedisSet(RedisDAO):
         return self.conn.delete(self.name)
 
 
-class RedisSetDict(defaultdict):
+class RedisTimedSet(RedisSet):
+    """
+    Redis sorted set of values scored by the time they were added.
+    Values older than window seconds count as absent. They and the oldest values
+    beyond size are pruned in the same round trip as every addition, so at most
+    size values are held. The key expires after window seconds without additions.
+
+    :param name: name of set, stored under key prefix + name
+
+    :param window: seconds values are kept, None for no limit
+
+    :param size: number of values kept, None for no limit
+
+    :param prefix: key prefix, so the key does not collide with a RedisSet of the same name
+
+    """
+    def __init__(self, name=None, host='localhost', port=6379, *args, window=None, size=None,
+                 prefix='timed_set:', **kwargs):
+        super().__init__(name, host, port, *args, **kwargs)
+        self.name = prefix + str(name)
+        self.window = window
+        self.size = size
+
+    def min_score(self):
+        return time() - self.window if self.window else '-inf'
+
+    def is_live(self, score):
+        return score is not None and (not self.window or score >= time() - self.window)
+
+    def add_pipeline(self, values):
+        """
+        add values not in set yet, and refresh the ones expired
+
+        :return: list of 1 for each value (re)added, 0 for each still in set
+        """
+        now = time()
+        pipe = self.conn.pipeline(transaction=False)
+        for value in values:
+            pipe.zscore(self.name, self.__valueEncode__(value))
+        scores = pipe.execute()
+        added = {}
+        for value, score in zip(values, scores):
+            if not self.is_live(score):
+                added[self.__valueEncode__(value)] = now
+        if added:
+            pipe.zadd(self.name, added)
+            if self.window:
+                pipe.expire(self.name, int(self.window) + 1)
+            self.prune_pipeline(pipe)
+            pipe.execute()
+        return [int(not self.is_live(score)) for score in scores]
+
+    @metrics.timed('redis.timed_set.add')
+    def add(self, value):
+        return self.add_pipeline([value])[0]
+
+    @metrics.timed('redis.timed_set.add_many')
+    def add_many(self, values):
+        return self.add_pipeline(values)
+
+    @metrics.timed('redis.timed_set.contains_many')
+    def contains_many(self, values):
+        pipe = self.conn.pipeline(transaction=False)
+        for value in values:
+            pipe.zscore(self.name, self.__valueEncode__(value))
+        return [self.is_live(score) for score in pipe.execute()]
+
+    @metrics.timed('redis.timed_set.contains')
+    def __contains__(self, item):
+        return self.is_live(self.conn.zscore(self.name, self.__valueEncode__(item)))
+
+    def prune_pipeline(self, pipe):
+        """
+        queue removal of expired values and the oldest beyond size on pipe
+        """
+        if self.window:
+            pipe.zremrangebyscore(self.name, '-inf', '(' + str(self.min_score()))
+        if self.size:
+            pipe.zremrangebyrank(self.name, 0, -self.size - 1)
+
+    @metrics.timed('redis.timed_set.prune')
+    def prune(self):
+        """
+        remove expired values and the oldest beyond size in one round trip
+        """
+        pipe = self.conn.pipeline(transaction=False)
+        self.prune_pipeline(pipe)
+        pipe.execute()
+
+    @metrics.timed('redis.timed_set.refresh_oldest')
+    def refresh_oldest(self, values):
+        """
+        mark the value of values seen longest ago as seen now
+
+        :return: that value, None if values is empty
+        """
+        if not values:
+            return None
+        pipe = self.conn.pipeline(transaction=False)
+        for value in values:
+            pipe.zscore(self.name, self.__valueEncode__(value))
+        scores = pipe.execute()
+        # values never added or pruned already count as the oldest
+        oldest = min(zip(values, scores), key=lambda item: item[1] or 0.)[0]
+        pipe.zadd(self.name, {self.__valueEncode__(oldest): time()})
+        if self.window:
+            pipe.expire(self.name, int(self.window) + 1)
+        self.prune_pipeline(pipe)
+        pipe.execute()
+        return oldest
+
+    @metrics.timed('redis.timed_set.pop')
+    def pop(self):
+        """
+        remove and return the oldest value in window
+        """
+        self.prune()
+        pipe = self.conn.pipeline()
+        pipe.zrange(self.name, 0, 0)
+        pipe.zremrangebyrank(self.name, 0, 0)
+        values = pipe.execute()[0]
+        return self.__valueDecode__(values[0]) if values else None
+
+    @metrics.timed('redis.timed_set.remove')
+    def remove(self, value):
+        return int(self.conn.zrem(self.name, self.__valueEncode__(value)))
+
+    def items(self):
+        return {self.__valueDecode__(_) for _ in self.conn.zrangebyscore(self.name, self.min_score(), '+inf')}
+
+    def __len__(self):
+        return self.conn.zcount(self.name, self.min_score(), '+inf')
+
+
+class RedisSetDict(IdleDict):
     """
-    defaultdict mapping to RedisSet objects
+    dict mapping to RedisSet objects, which are created when missing.
+    All RedisSet objects share one connection pool. Idle ones are dropped,
+    since their data stays in redis.
 
     :param host: redis server host name
 
@@ -90,20 +252,65 @@ class RedisSetDict(defaultdict):
 
     :param db: redis server database index
 
-    :param kwargs: other parameters
+    :param set_class: RedisSet or a subclass, like RedisTimedSet
+
+    :param set_kwargs: other parameters of set_class, like window and size of RedisTimedSet
+
+    :param kwargs: other parameters of IdleDict, such as max_size and idle_timeout
 
     """
-    __slots__ = {'host', 'port', 'db'}
 
-    def __init__(self, host='localhost', port=6379, db=0, **kwargs):
-        super().__init__(**kwargs)
+    def __init__(self, host='localhost', port=6379, db=0, set_class=RedisSet, set_kwargs=None, **kwargs):
+        super().__init__(self.create, **kwargs)
         self.host = host
         self.port = port
         self.db = db
+        self.set_class = set_class
+        self.set_kwargs = set_kwargs or {}
+        self.pool = redis.ConnectionPool(host=host, port=port, db=db)
+
+    def create(self, key):
+        return self.set_class(key, self.host, self.port, connection_pool=self.pool, **self.set_kwargs)
 
-    def __missing__(self, key):
-        ret = self[key] = RedisSet(key, self.host, self.port, db=self.db)
-        return ret
+
+class RedisHash(RedisDAO):
+    """
+    dict-like Redis hash named name. Values are pickled unless they are int, float or str.
+    """
+
+    def __getitem__(self, key):
+        result = self.conn.hget(self.name, self.__valueEncode__(key))
+        if result is None:
+            raise KeyError(key)
+        return self.__valueDecode__(result)
+
+    def __setitem__(self, key, value):
+        return self.conn.hset(self.name, self.__valueEncode__(key), self.__valueEncode__(value))
+
+    def __delitem__(self, key):
+        return self.conn.hdel(self.name, self.__valueEncode__(key))
+
+    def __contains__(self, key):
+        return bool(self.conn.hexists(self.name, self.__valueEncode__(key)))
+
+    def __len__(self):
+        return self.conn.hlen(self.name)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, mapping):
+        """
+        set all items of mapping in one round trip
+        """
+        if mapping:
+            self.conn.hmset(
+                self.name,
+                {self.__valueEncode__(k): self.__valueEncode__(v) for k, v in mapping.items()}
+            )
 
 
 class RedisList(RedisDAO):
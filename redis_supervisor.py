@@ -0,0 +1,201 @@
+"""
+Start the local redis servers of the bot once, with their own config, and watch them.
+
+The persistent instance keeps seen pictures and recent ids on disk,
+the cache instance only holds what can be fetched again and evicts least recently used keys.
+A server already listening on a port is used as it is, and started again like the others if it goes down.
+Servers are supervised by the front process in shard mode, or the single process otherwise.
+Shards and handler modules only wait for them with wait_ready.
+"""
+import logging
+import os
+import subprocess
+import threading
+from time import monotonic, sleep
+
+import redis
+
+import config
+import metrics
+
+# Constants
+PERSISTENT_CONFIG = """
+appendonly yes
+appendfsync everysec
+appendfilename "appendonly-{port}.aof"
+dbfilename "dump-{port}.rdb"
+save 900 1
+save 300 10
+save 60 10000
+"""
+CACHE_CONFIG = """
+maxmemory {maxmemory}
+maxmemory-policy allkeys-lru
+save ""
+appendonly no
+"""
+CHECK_INTERVAL = 5.  # seconds between health checks
+STARTUP_TIMEOUT = 10.  # seconds to wait for servers to accept connections
+RESTART_BACKOFF = 30.  # min seconds between restarts of one server
+
+lock = threading.Lock()
+supervisor = None  # RedisSupervisor of this process
+supervisor_pid = None  # process which started supervisor, forked children start their own
+
+
+class RedisInstance:
+    def __init__(self, port, extra_config, host='127.0.0.1'):
+        """
+        A local redis server
+
+        :param port: port listened to
+
+        :param extra_config: lines of redis.conf for this server
+
+        :param host: address bound
+        """
+        self.host = host
+        self.port = port
+        self.extra_config = extra_config
+        self.conn = redis.Redis(host=host, port=port, socket_timeout=1, socket_connect_timeout=1)
+        self.process = None  # last redis-server started by this process, None if running already
+        self.started_at = None
+        self.up = False
+
+    def ping(self):
+        try:
+            self.up = bool(self.conn.ping())
+        except redis.exceptions.RedisError:
+            self.up = False
+        return self.up
+
+    def write_config(self, directory):
+        path = os.path.join(directory, 'redis-{}.conf'.format(self.port))
+        with open(path, 'w') as fp:
+            fp.write("bind {}\nport {}\ndir \"{}\"\n".format(self.host, self.port, directory))
+            fp.write(self.extra_config)
+        return path
+
+    def spawn(self, directory):
+        """
+        start redis-server detached, so it keeps running across restarts of the bot
+        """
+        self.started_at = monotonic()
+        metrics.incr('redis.{}.spawned'.format(self.port))
+        try:
+            self.process = subprocess.Popen(
+                ['redis-server', self.write_config(directory)],
+                stdout=open(os.devnull, 'w'),
+                stderr=subprocess.STDOUT,
+                start_new_session=True
+            )
+        except OSError as e:
+            logging.error("starting redis-server on port {} failed: {}".format(self.port, e))
+
+
+class RedisSupervisor:
+    def __init__(self, instances, directory, check_interval=CHECK_INTERVAL):
+        """
+        Start redis servers which are not running, and check them every check_interval seconds.
+        Servers which go down are started again, whoever started them before.
+        ready is set while all servers accept connections.
+
+        :param instances: list of RedisInstance
+
+        :param directory: directory of config and data files
+
+        :param check_interval: seconds between health checks
+        """
+        self.instances = instances
+        self.directory = directory
+        self.check_interval = check_interval
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        for instance in instances:
+            metrics.register_gauge('redis.{}.up'.format(instance.port), lambda i=instance: int(i.up))
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for instance in self.instances:
+            if not instance.ping():
+                instance.spawn(self.directory)
+        deadline = monotonic() + STARTUP_TIMEOUT
+        while not self.check() and monotonic() < deadline:
+            self.stopped.wait(0.1)
+        threading.Thread(target=self.watch, name='redis_supervisor', daemon=True).start()
+
+    def check(self):
+        """
+        ping every server, set or clear ready accordingly
+
+        :return: True if all servers are up
+        """
+        up = all([instance.ping() for instance in self.instances])
+        if up:
+            self.ready.set()
+        else:
+            self.ready.clear()
+        return up
+
+    def watch(self):
+        while not self.stopped.wait(self.check_interval):
+            if self.check():
+                continue
+            for instance in self.instances:
+                if instance.up:
+                    continue
+                logging.warning("redis on port {} is down".format(instance.port))
+                metrics.incr('redis.{}.down'.format(instance.port))
+                if instance.started_at is not None and monotonic() - instance.started_at < RESTART_BACKOFF:
+                    continue
+                if instance.process is not None and instance.process.poll() is None:
+                    # started by this process but not answering, so it holds the port
+                    instance.process.kill()
+                    instance.process.wait()
+                instance.spawn(self.directory)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def instances():
+    return [
+        RedisInstance(config.REDIS_PORT, PERSISTENT_CONFIG.format(port=config.REDIS_PORT)),
+        RedisInstance(config.REDIS_LRU_PORT, CACHE_CONFIG.format(maxmemory=config.REDIS_LRU_MAXMEMORY)),
+    ]
+
+
+def start():
+    """
+    start and watch the persistent and the cache redis servers of config, once per process.
+    Called by the front or single process only.
+
+    :return: RedisSupervisor
+    """
+    global supervisor, supervisor_pid
+    with lock:
+        if supervisor is None or supervisor_pid != os.getpid():
+            supervisor_pid = os.getpid()
+            supervisor = RedisSupervisor(instances(), config.REDIS_DIR)
+            supervisor.start()
+    return supervisor
+
+
+def wait_ready(timeout=STARTUP_TIMEOUT):
+    """
+    wait until all redis servers accept connections, without starting them
+
+    :return: True if ready within timeout
+    """
+    if supervisor is not None and supervisor_pid == os.getpid():
+        ready = supervisor.ready.wait(timeout)
+    else:
+        # a shard, or a process which uses servers started by someone else
+        waited = instances()
+        deadline = monotonic() + timeout
+        while not all([instance.ping() for instance in waited]) and monotonic() < deadline:
+            sleep(0.1)
+        ready = all(instance.up for instance in waited)
+    if not ready:
+        logging.error("redis is not ready after {}s".format(timeout))
+    return ready
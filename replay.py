@@ -0,0 +1,115 @@
+"""
+Replay recorded traffic through the bot handlers against local stand-ins (see fakes.py).
+redis-server must be on PATH.
+
+Usage: python3 replay.py RECORDING [RECORDING ...] [--speed X] [--limit N] [--output FILE] ...
+
+A recording is a compact log written when TRAFFIC_LOG is set (*.jsonl),
+or a message_of_<chat_id> file written by chat.record.
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import tempfile
+from itertools import islice
+from threading import active_count
+from time import time, sleep
+
+import telegram
+
+import metrics
+from fakes import Harness
+from traffic import read_traffic
+
+
+def replay(harness, traffic, speed=1.):
+    """
+    feed recorded traffic to harness and wait for all updates to be handled
+
+    :param traffic: iterable of (timestamp, update dict)
+
+    :param speed: replay speed relative to the recording, 0 feeds as fast as possible
+
+    :return: (number of updates, seconds elapsed)
+    """
+    count = 0
+    first = None
+    start = time()
+    for timestamp, data in traffic:
+        if first is None:
+            first = timestamp
+        if speed:
+            wait = start + (timestamp - first) / speed - time()
+            if wait > 0:
+                sleep(wait)
+        count += 1
+        data['update_id'] = count
+        harness.feed(telegram.Update.de_json(data, harness.bot))
+    harness.wait_idle()
+    return count, time() - start
+
+
+def resource_usage():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime, usage.ru_stime, usage.ru_maxrss
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replay recorded traffic against local stand-ins")
+    parser.add_argument('recordings', nargs='+', help="compact logs (*.jsonl) or message_of_<chat_id> files")
+    parser.add_argument('--speed', type=float, default=1., help="times faster than recorded, 0 for no waiting")
+    parser.add_argument('--limit', type=int, default=0, help="replay only the first N updates")
+    parser.add_argument('--output', help="write per-handler latency and resource usage to this JSON file")
+    parser.add_argument('--bot-latency', type=float, default=0.05, help="seconds per Telegram call")
+    parser.add_argument('--gelbooru-latency', type=float, default=0.1, help="seconds per Gelbooru request")
+    parser.add_argument('--shortener-latency', type=float, default=0.01, help="seconds per shortener request")
+    parser.add_argument('--redis-port', type=int, default=16379)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    recordings = [os.path.abspath(name) for name in args.recordings]
+    harness = Harness(
+        bot_latency=args.bot_latency,
+        gelbooru_latency=args.gelbooru_latency,
+        shortener_latency=args.shortener_latency,
+        redis_port=args.redis_port
+    )
+    # chat.record writes message_of_<chat_id> files into the working directory
+    os.chdir(tempfile.mkdtemp(prefix='replay_'))
+    try:
+        traffic = read_traffic(recordings)
+        if args.limit:
+            traffic = islice(traffic, args.limit)
+        user_time, system_time, _ = resource_usage()
+        count, elapsed = replay(harness, traffic, args.speed)
+        end_user_time, end_system_time, max_rss = resource_usage()
+    finally:
+        harness.close()
+
+    print("{} updates in {:.2f}s, {:.1f} updates/s".format(count, elapsed, count / elapsed if elapsed else 0.))
+    print("CPU user {:.2f}s, system {:.2f}s, max RSS {} KiB, threads {}".format(
+        end_user_time - user_time, end_system_time - system_time, max_rss, active_count()
+    ))
+    print("Telegram API calls: {}".format(
+        ', '.join("{}={}".format(k, v) for k, v in sorted(harness.bot.calls.items()))
+    ))
+    print(metrics.summary())
+
+    if args.output:
+        timings, counters, _ = metrics.snapshot()
+        with open(args.output, 'w') as fp:
+            json.dump({
+                'updates': count,
+                'seconds': elapsed,
+                'cpu_user_seconds': end_user_time - user_time,
+                'cpu_system_seconds': end_system_time - system_time,
+                'max_rss_kib': max_rss,
+                'telegram_calls': dict(harness.bot.calls),
+                'timings': {
+                    name: {'count': c, 'total': total, 'max': max_seconds, 'percentiles': percentiles}
+                    for name, (c, total, max_seconds, percentiles) in timings.items()
+                },
+                'counters': counters,
+            }, fp, indent=2, sort_keys=True)
@@ -0,0 +1,266 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from time import monotonic
+
+from lru import LRU
+
+import metrics
+
+# Constants
+FAILURE_THRESHOLD = 5  # consecutive failures before a breaker opens
+RESET_TIMEOUT = 30.  # seconds an open breaker fails fast before letting a trial call through
+REFRESH_WORKERS = 4
+
+current = threading.local()  # started of the call submitted by submit running in this thread
+
+
+class Unavailable(Exception):
+    """
+    raised when an upstream service fails fast or misses its deadline
+    """
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT, slow_call=None):
+        """
+        Fail fast while upstream service name keeps failing.
+        After failure_threshold consecutive failures, calls raise Unavailable for reset_timeout seconds.
+        Then one trial call is let through, which closes the breaker again if it succeeds.
+        It is threading-safe.
+
+        :param name: name of upstream service, used in metrics
+
+        :param failure_threshold: consecutive failures before opening
+
+        :param reset_timeout: seconds before a trial call
+
+        :param slow_call: seconds after which a call counts as failure even if it succeeds, None for no limit
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call = slow_call
+        self.failures = 0
+        self.opened_at = None  # None while closed
+        self.trial = False  # a trial call is in flight
+        self.lock = threading.Lock()
+        metrics.register_gauge('breaker.{}.open'.format(name), lambda: int(self.opened_at is not None))
+
+    def before(self):
+        """
+        :raise Unavailable: if the breaker is open
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if not self.trial and monotonic() - self.opened_at >= self.reset_timeout:
+                self.trial = True
+                return
+        metrics.incr('breaker.{}.rejected'.format(self.name))
+        raise Unavailable("{} is unavailable".format(self.name))
+
+    def success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logging.warning("{} recovered".format(self.name))
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or (self.opened_at is None and self.failures >= self.failure_threshold):
+                if self.opened_at is None:
+                    logging.warning("{} failed {} times, failing fast".format(self.name, self.failures))
+                metrics.incr('breaker.{}.opened'.format(self.name))
+                self.opened_at = monotonic()
+                self.trial = False
+
+    def call(self, func, *args, **kwargs):
+        """
+        call func through the breaker. In a call submitted by submit, a failure is not counted
+        again if one was already counted for its request, like a deadline missed by wait.
+        """
+        self.before()
+        start = monotonic()
+        started = getattr(current, 'started', None)
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            if started is None or started.claim_failure():
+                self.failure()
+            raise
+        if self.slow_call is not None and monotonic() - start > self.slow_call:
+            if started is None or started.claim_failure():
+                self.failure()
+        elif started is None or not started.failed:
+            self.success()
+        return result
+
+
+class Started(threading.Event):
+    """
+    Event set when a call submitted to an executor starts running, with the time it started.
+    It also records whether a failure was counted for the request, so it is counted once
+    however many futures wait for it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.time = None
+        self.failed = False
+        self.failed_lock = threading.Lock()
+
+    def mark(self):
+        self.time = monotonic()
+        self.set()
+
+    def claim_failure(self):
+        """
+        :return: True for the first failure of the request, which should be counted
+        """
+        with self.failed_lock:
+            if self.failed:
+                return False
+            self.failed = True
+            return True
+
+
+def submit(executor, func, *args, started: Started = None, **kwargs):
+    """
+    submit func(*args, **kwargs) to executor, returning a future whose started is marked
+    when func starts running, so wait does not count time queued in executor against its deadline
+
+    :param started: Started to mark, shared by futures of one request. A new one if None.
+    """
+    started = started or Started()
+
+    def run():
+        started.mark()
+        current.started = started
+        try:
+            return func(*args, **kwargs)
+        finally:
+            current.started = None
+
+    future = executor.submit(run)
+    future.started = started
+    return future
+
+
+def wait(future, timeout, breaker: CircuitBreaker = None, queue_timeout=None):
+    """
+    wait for result of future at most timeout seconds, counting a miss as failure of breaker,
+    so calls which never return open it too. A miss is counted once per started, for all
+    futures waiting for the same request.
+    For futures with a started Started, the deadline runs from when the call started. Waiting
+    longer than queue_timeout for it to start raises Unavailable without counting as failure,
+    since only local workers are busy.
+
+    :param queue_timeout: seconds to wait for the call to start, timeout if None
+
+    :raise Unavailable: when the deadline is missed
+    """
+    name = breaker.name if breaker else 'call'
+    remaining = timeout
+    started = getattr(future, 'started', None)
+    if started is not None:
+        queue_timeout = timeout if queue_timeout is None else queue_timeout
+        if not started.wait(queue_timeout):
+            metrics.incr('deadline.{}.queued'.format(name))
+            raise Unavailable("{} has too many requests in flight".format(name))
+        remaining = max(0., timeout - (monotonic() - started.time))
+    try:
+        return future.result(remaining)
+    except TimeoutError:
+        if started is None or started.claim_failure():
+            metrics.incr('deadline.{}.missed'.format(name))
+            if breaker:
+                breaker.failure()
+        raise Unavailable("{} missed its deadline of {}s".format(name, timeout))
+
+
+class StaleCache:
+    def __init__(self, name, max_size, fresh_time, max_stale):
+        """
+        LRU cache serving values stale while refreshing them in the background.
+        A value younger than fresh_time is served as is. An older one is served
+        and reloaded in the background, once at a time per key. A value older than
+        max_stale is only served when reloading it fails.
+        It is threading-safe.
+
+        :param name: name used in metrics
+
+        :param max_size: max number of keys
+
+        :param fresh_time: seconds a value is served without reloading
+
+        :param max_stale: seconds a value is served before it must be reloaded first
+        """
+        self.name = name
+        self.fresh_time = fresh_time
+        self.max_stale = max_stale
+        self.data = LRU(max_size)  # key -> (value, loaded time)
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS)
+        metrics.register_gauge('{}.size'.format(name), lambda: len(self.data))
+
+    def lookup(self, key):
+        """
+        :return: (value, age in seconds), or (None, None) if missing
+        """
+        entry = self.data.get(key)
+        if entry is None:
+            return None, None
+        return entry[0], monotonic() - entry[1]
+
+    def put(self, key, value):
+        self.data[key] = (value, monotonic())
+
+    def refresh(self, key, load):
+        """
+        reload key with load() in the background, unless it is already being reloaded
+        """
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def reload():
+            try:
+                self.put(key, load())
+                metrics.incr('{}.refreshed'.format(self.name))
+            except Exception as e:
+                logging.warning("refreshing {} of {} failed: {}".format(key, self.name, e))
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        self.executor.submit(reload)
+
+    def get(self, key, load):
+        """
+        :param load: function loading the value of key
+
+        :return: cached or loaded value
+        """
+        value, age = self.lookup(key)
+        if age is not None and age < self.max_stale:
+            metrics.hit(self.name, True)
+            if age >= self.fresh_time:
+                self.refresh(key, load)
+            return value
+        metrics.hit(self.name, False)
+        try:
+            value = load()
+        except Exception:
+            if age is None:
+                raise
+            metrics.incr('{}.served_expired'.format(self.name))
+            return value
+        self.put(key, value)
+        return value
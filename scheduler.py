@@ -0,0 +1,354 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from multiprocessing import Pipe, Pool, Process, TimeoutError, cpu_count
+from time import monotonic, perf_counter
+
+import telegram
+from lru import LRU
+from telegram.ext import Dispatcher
+
+import metrics
+
+# Constants
+WORKERS = 16  # tasks run at the same time, for all chats
+CPU_WORKERS = cpu_count()  # processes of the cpu pool
+CPU_MAX_QUEUE = 64  # pending tasks of the cpu lane, for all chats, whatever the number of cores
+LONG_WORKERS = 2  # long jobs run at the same time, for all chats
+BUSY_TEXT = "Busy right now, please try again in a moment"
+BUSY_REPLY_INTERVAL = 10.  # min seconds between busy replies to one chat
+PER_CHAT_LIMIT = 1  # tasks of one chat run at the same time, 1 keeps replies in order
+MAX_CHAT_QUEUE = 8  # pending tasks of one chat, new tasks are rejected beyond this
+MAX_TOTAL_QUEUE = 256  # pending tasks of all chats, new tasks are rejected beyond this
+
+
+class ChatScheduler:
+    def __init__(
+            self,
+            workers=WORKERS,
+            per_chat_limit=PER_CHAT_LIMIT,
+            max_chat_queue=MAX_CHAT_QUEUE,
+            max_total_queue=MAX_TOTAL_QUEUE,
+            name='scheduler'
+    ):
+        """
+        Run tasks from per-chat FIFO queues on a bounded pool of threads.
+        Chats with pending tasks are served round-robin, so one busy chat
+        can not take every worker while other chats wait.
+        It is threading-safe.
+
+        :param workers: max number of tasks running at the same time
+
+        :param per_chat_limit: max number of tasks of a single chat running at the same time
+
+        :param max_chat_queue: max number of pending tasks of a single chat
+
+        :param max_total_queue: max number of pending tasks of all chats
+
+        :param name: prefix of worker thread names
+        """
+        self.workers = workers
+        self.per_chat_limit = per_chat_limit
+        self.max_chat_queue = max_chat_queue
+        self.max_total_queue = max_total_queue
+        self.name = name
+
+        self.queues = {}  # chat key -> deque of pending tasks
+        self.running = {}  # chat key -> number of running tasks
+        # chat keys which have pending tasks and are under per_chat_limit, in round-robin order
+        self.ready = deque()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.has_work = threading.Condition(self.lock)
+        self.threads = []
+
+    def start(self):
+        """
+        start worker threads if not started yet
+
+        :return: None
+        """
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    name="{}_{}".format(self.name, i),
+                    daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        queue func(*args, **kwargs) to run after earlier tasks of the same chat
+
+        :param key: chat key, usually chat_id
+
+        :param func: callable to run
+
+        :return: True if queued. False if rejected because queues are full.
+        """
+        if not self.threads:
+            self.start()
+
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue is not None and len(queue) >= self.max_chat_queue:
+                return False
+            # reject at once, the dispatcher thread is shared by all lanes and must never wait on one
+            if self.pending >= self.max_total_queue:
+                return False
+
+            if queue is None:
+                queue = self.queues[key] = deque()
+            queue.append((perf_counter(), func, args, kwargs))
+            self.pending += 1
+            if len(queue) == 1 and self.running.get(key, 0) < self.per_chat_limit:
+                self.ready.append(key)
+                self.has_work.notify()
+        return True
+
+    def qsize(self, key=None):
+        """
+        :param key: chat key. If None, count pending tasks of all chats.
+
+        :return: number of pending tasks
+        """
+        with self.lock:
+            if key is None:
+                return self.pending
+            return len(self.queues.get(key, ()))
+
+    def is_idle(self):
+        """
+        :return: True if no task is pending or running
+        """
+        with self.lock:
+            return not self.pending and not self.running
+
+    def _work(self):
+        while True:
+            with self.lock:
+                self.has_work.wait_for(lambda: self.ready)
+                key = self.ready.popleft()
+                queue = self.queues[key]
+                queued_time, func, args, kwargs = queue.popleft()
+                self.pending -= 1
+                self.running[key] = self.running.get(key, 0) + 1
+                # put the chat back at the tail so other chats get their turn first
+                if queue and self.running[key] < self.per_chat_limit:
+                    self.ready.append(key)
+
+            metrics.observe('lane.{}.wait'.format(self.name), perf_counter() - queued_time)
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logging.exception("{} task {} raised {}".format(self.name, getattr(func, '__name__', func), e))
+            finally:
+                # from submit to the end of the task, only tasks which were not rejected
+                metrics.observe('lane.{}.latency'.format(self.name), perf_counter() - queued_time)
+                with self.lock:
+                    self.running[key] -= 1
+                    if queue:
+                        if self.running[key] == self.per_chat_limit - 1:
+                            self.ready.append(key)
+                            self.has_work.notify()
+                    elif not self.running[key]:
+                        del self.running[key]
+                        del self.queues[key]
+
+
+# executor lanes which handlers choose from when registered.
+# Each lane has its own workers, so slow work in one lane never starves another.
+LANES = {
+    # latency-sensitive handlers blocking on HTTP and Telegram
+    'io': ChatScheduler(name='io'),
+    # handlers which hand heavy computation to the cpu pool by run_in_process
+    'cpu': ChatScheduler(workers=CPU_WORKERS, max_total_queue=CPU_MAX_QUEUE, name='cpu'),
+    # handlers which may run for minutes, such as downloads
+    'long': ChatScheduler(workers=LONG_WORKERS, max_chat_queue=1, max_total_queue=16, name='long'),
+}
+for lane in LANES.values():
+    metrics.register_gauge('lane.{}.pending'.format(lane.name), lane.qsize)
+cpu_pool = None
+cpu_pool_lock = threading.Lock()
+# busy replies are sent off the dispatcher thread, at most once per BUSY_REPLY_INTERVAL per chat
+busy_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='busy')
+busy_replied = LRU(10000)  # chat id -> time of last busy reply
+
+
+def run_in_process(func, *args, timeout=None):
+    """
+    run func(*args) in the cpu process pool. The pool is shared by all callers and never
+    terminated, so work timing out keeps running there; use run_killable for work which may not end.
+
+    :param func: picklable function, i.e. defined at module level
+
+    :param timeout: seconds to wait for the result
+
+    :return: return value of func
+
+    :raise multiprocessing.TimeoutError: when timeout is reached.
+    """
+    global cpu_pool
+
+    with cpu_pool_lock:
+        if cpu_pool is None:
+            cpu_pool = Pool(CPU_WORKERS)
+        pool = cpu_pool
+
+    return pool.apply_async(func, args).get(timeout)
+
+
+def run_child(conn, func, args):
+    try:
+        conn.send((True, func(*args)))
+    except Exception as e:
+        conn.send((False, e))
+    finally:
+        conn.close()
+
+
+def run_killable(func, *args, timeout):
+    """
+    run func(*args) in a process of its own, killed when timeout is reached
+
+    :param func: picklable function, i.e. defined at module level
+
+    :param timeout: seconds to wait for the result
+
+    :return: return value of func
+
+    :raise multiprocessing.TimeoutError: when timeout is reached.
+    """
+    reader, writer = Pipe(duplex=False)
+    process = Process(target=run_child, args=(writer, func, args), daemon=True)
+    process.start()
+    writer.close()
+    try:
+        if not reader.poll(timeout):
+            process.terminate()
+            raise TimeoutError("{} did not finish in {}s".format(getattr(func, '__name__', func), timeout))
+        try:
+            ok, value = reader.recv()
+        except EOFError:
+            raise RuntimeError("process of {} exited without a result".format(getattr(func, '__name__', func)))
+    finally:
+        reader.close()
+        process.join()
+    if not ok:
+        raise value
+    return value
+
+
+def start():
+    for lane in LANES.values():
+        lane.start()
+
+
+def chat_key(update: telegram.Update):
+    if not isinstance(update, telegram.Update):
+        return None
+    if update.inline_query:
+        # apart from the private chat of the user, so inline queries do not wait behind commands
+        return 'inline', update.inline_query.from_user.id
+    chat = update.effective_chat or update.effective_user
+    return chat.id if chat else None
+
+
+def call_handler(func, bot, update, *args, **kwargs):
+    try:
+        func(bot, update, *args, **kwargs)
+    except telegram.TelegramError as e:
+        # keep error_callback working the same as for synchronous handlers
+        Dispatcher.get_instance().dispatch_error(update, e)
+
+
+def reply_busy(bot, update):
+    """
+    tell the sender of a dropped command to try again, so it is not left without an answer
+    """
+    message = update.effective_message if isinstance(update, telegram.Update) else None
+    if not message or not (message.text or '').startswith('/'):
+        return
+    now = monotonic()
+    last = busy_replied.get(message.chat_id)
+    if last is not None and now - last < BUSY_REPLY_INTERVAL:
+        return
+    busy_replied[message.chat_id] = now
+    busy_executor.submit(
+        call_handler,
+        lambda bot, update: bot.send_message(
+            chat_id=message.chat_id,
+            reply_to_message_id=message.message_id,
+            text=BUSY_TEXT
+        ),
+        bot,
+        update
+    )
+
+
+def run_scheduled(func, lane='io'):
+    """
+    Wrap a handler to run on a lane instead of the dispatcher thread.
+    Handlers of one chat in the same lane run in the order their updates arrive.
+
+    :param func: handler callback
+
+    :param lane: key of LANES
+
+    :return: wrapped handler
+    """
+    scheduler = LANES[lane]
+
+    @wraps(func)
+    def scheduled_func(bot, update, *args, **kwargs):
+        key = chat_key(update)
+        if not scheduler.submit(key, call_handler, func, bot, update, *args, **kwargs):
+            metrics.incr('lane.{}.rejected'.format(lane))
+            logging.warning("{} dropped for chat {}: {} lane is full".format(func.__name__, key, lane))
+            reply_busy(bot, update)
+
+    return scheduled_func
+
+
+def run_latest(func, lane='io'):
+    """
+    Wrap a handler to run on a lane, keeping only the latest update of each chat waiting to run.
+    An update arriving while an older one waits replaces it, for updates which supersede
+    each other, like inline queries sent as the user types.
+
+    :param func: handler callback
+
+    :param lane: key of LANES
+
+    :return: wrapped handler
+    """
+    scheduler = LANES[lane]
+    latest = {}  # chat key -> (bot, update, args, kwargs) waiting to run
+    lock = threading.Lock()
+
+    def run(key):
+        with lock:
+            bot, update, args, kwargs = latest.pop(key)
+        call_handler(func, bot, update, *args, **kwargs)
+
+    @wraps(func)
+    def scheduled_func(bot, update, *args, **kwargs):
+        key = chat_key(update)
+        with lock:
+            waiting = key in latest
+            latest[key] = (bot, update, args, kwargs)
+        if waiting:
+            metrics.incr('lane.{}.superseded'.format(lane))
+        elif not scheduler.submit(key, run, key):
+            with lock:
+                latest.pop(key, None)
+            metrics.incr('lane.{}.rejected'.format(lane))
+            logging.warning("{} dropped for chat {}: {} lane is full".format(func.__name__, key, lane))
+
+    return scheduled_func
@@ -0,0 +1,119 @@
+import logging
+from multiprocessing import get_context
+from threading import Event, Thread
+from time import monotonic
+
+import telegram
+
+from scheduler import chat_key
+import metrics
+
+# Constants
+CHECK_INTERVAL = 1.  # seconds between liveness checks of shard processes
+RESTART_BACKOFF = 5.  # min seconds between restarts of one shard
+# shards are not forked from the front process, whose other threads may hold locks at fork time
+START_METHOD = 'spawn'
+
+
+def shard_of(chat_id, shards):
+    """
+    :param chat_id: chat key of scheduler.chat_key, None for updates without a chat
+
+    :param shards: number of shards
+
+    :return: index of the shard which serves chat_id
+    """
+    if isinstance(chat_id, tuple):
+        # keys like ('inline', user_id) go to the shard of the user
+        chat_id = chat_id[-1]
+    try:
+        return int(chat_id) % shards
+    except (TypeError, ValueError):
+        return 0
+
+
+class ShardRouter:
+    def __init__(self, shards, shard_main):
+        """
+        Route updates to worker processes by chat id.
+        All updates of a chat go to the same worker in the order they are routed.
+        A worker which exits is started again on the same queue, so its chats are served again.
+
+        :param shards: number of worker processes
+
+        :param shard_main: target of worker processes, called as shard_main(index, queue).
+        It should serve update dicts from queue by serve_shard until None is received,
+        and be importable, as worker processes are spawned.
+        """
+        self.shard_main = shard_main
+        self.context = get_context(START_METHOD)
+        self.queues = [self.context.Queue() for _ in range(shards)]
+        self.processes = [self.create_process(i) for i in range(shards)]
+        self.started_at = [None] * shards
+        self.stopped = Event()
+        for i, queue in enumerate(self.queues):
+            metrics.register_gauge('shard.{}.pending'.format(i), queue.qsize)
+            metrics.register_gauge('shard.{}.up'.format(i), lambda i=i: int(self.processes[i].is_alive()))
+
+    def create_process(self, index):
+        return self.context.Process(target=self.shard_main, args=(index, self.queues[index]), name="shard_{}".format(index))
+
+    def start_process(self, index):
+        self.started_at[index] = monotonic()
+        self.processes[index].start()
+
+    def start(self):
+        for i in range(len(self.processes)):
+            self.start_process(i)
+        Thread(target=self.watch, name='shard_watch', daemon=True).start()
+
+    def watch(self):
+        while not self.stopped.wait(CHECK_INTERVAL):
+            for i, process in enumerate(self.processes):
+                if process.is_alive() or self.stopped.is_set():
+                    continue
+                if monotonic() - self.started_at[i] < RESTART_BACKOFF:
+                    continue
+                logging.error("shard {} exited with code {}, restarting it".format(i, process.exitcode))
+                metrics.incr('shard.{}.restarted'.format(i))
+                self.processes[i] = self.create_process(i)
+                self.start_process(i)
+
+    def stop(self):
+        self.stopped.set()
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join()
+
+    def route(self, bot: telegram.Bot, update: telegram.Update):
+        """
+        handler callback of the front dispatcher
+        """
+        shard = shard_of(chat_key(update), len(self.queues))
+        self.queues[shard].put(update.to_dict())
+
+
+def serve_shard(queue, updater):
+    """
+    decode update dicts from queue and dispatch them with updater until None is received
+
+    :param queue: queue of a shard
+
+    :param updater: telegram.ext.Updater with handlers registered
+
+    :return: None
+    """
+    dispatcher_thread = Thread(target=updater.dispatcher.start, name='dispatcher', daemon=True)
+    dispatcher_thread.start()
+    updater.job_queue.start()
+    while True:
+        data = queue.get()
+        if data is None:
+            break
+        try:
+            updater.update_queue.put(telegram.Update.de_json(data, updater.bot))
+        except Exception as e:
+            logging.error("can not decode update {}: {}".format(data, e))
+    updater.job_queue.stop()
+    updater.dispatcher.stop()
@@ -0,0 +1,185 @@
+"""
+Snapshot of in-process caches, written to a binary file and memory-mapped back at startup.
+
+Layout: a header of magic, format version and index offset, then one pickled record per
+cached value, then the index, a pickled dict of section -> {key: (offset, length)}.
+Only the index is unpickled when a snapshot is opened. Records are unpickled when their
+key is first used, so a restarted bot has warm caches without a load step.
+"""
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+
+import metrics
+
+# Constants
+MAGIC = b'APBSNAP\0'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIQ')  # magic, format version, index offset
+
+
+class Raw(bytes):
+    """
+    a record already pickled, copied to a new snapshot as it is
+    """
+    pass
+
+
+class Snapshot:
+    def __init__(self, path):
+        """
+        Read-only view of a snapshot file. A missing, truncated or outdated file reads as empty.
+
+        :param path: path of snapshot file, None for an empty snapshot
+        """
+        self.path = path
+        self.mmap = None
+        self.index = {}  # section -> {key: (offset, length)}
+        if not path:
+            return
+        try:
+            with open(path, 'rb') as fp:
+                self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, index_offset = HEADER.unpack_from(self.mmap, 0)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise ValueError("not a snapshot of version {}".format(FORMAT_VERSION))
+            self.index = pickle.loads(self.mmap[index_offset:])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, struct.error, pickle.UnpicklingError, EOFError) as e:
+            logging.warning("snapshot {} is not used: {}".format(path, e))
+            self.index = {}
+
+    def keys(self, section):
+        return self.index.get(section, {}).keys()
+
+    def contains(self, section, key):
+        return key in self.index.get(section, {})
+
+    def raw(self, section, key):
+        """
+        :return: Raw pickled record of key
+        """
+        offset, length = self.index[section][key]
+        return Raw(self.mmap[offset:offset + length])
+
+    def get(self, section, key):
+        """
+        :raise KeyError: if key is not in section
+        """
+        metrics.incr('snapshot.loaded')
+        return pickle.loads(self.raw(section, key))
+
+
+def write(path, sections):
+    """
+    write a snapshot, replacing path atomically. A Snapshot open on the old file stays readable.
+
+    :param sections: dict of section name -> iterable of (key, value), values may be Raw
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    index = {}
+    with open(tmp_path, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0))
+        for section, items in sections.items():
+            offsets = index[section] = {}
+            for key, value in items:
+                record = value if isinstance(value, Raw) else pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+                offsets[key] = (fp.tell(), len(record))
+                fp.write(record)
+        index_offset = fp.tell()
+        fp.write(pickle.dumps(index, protocol=pickle.HIGHEST_PROTOCOL))
+        fp.seek(0)
+        fp.write(HEADER.pack(MAGIC, FORMAT_VERSION, index_offset))
+    os.replace(tmp_path, path)
+
+
+class SnapshotCache:
+    def __init__(self, cache, snapshot: Snapshot, section):
+        """
+        Cache falling back to a snapshot section on misses,
+        moving a value into cache when its key is first used.
+        Other attributes are those of cache.
+
+        :param cache: dict-like cache, like an LRU
+
+        :param snapshot: Snapshot read on misses
+
+        :param section: section of snapshot
+        """
+        self.cache = cache
+        self.snapshot = snapshot
+        self.section = section
+        self.dropped = set()  # keys deleted, not to be read from snapshot again
+
+    def __contains__(self, key):
+        return key in self.cache or (key not in self.dropped and self.snapshot.contains(self.section, key))
+
+    def __getitem__(self, key):
+        try:
+            return self.cache[key]
+        except KeyError:
+            if key in self.dropped:
+                raise
+        value = self.snapshot.get(self.section, key)
+        self.cache[key] = value
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self.cache[key] = value
+
+    def __delitem__(self, key):
+        self.dropped.add(key)
+        if key in self.cache:
+            del self.cache[key]
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __iter__(self):
+        return iter(self.cache.keys())
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def snapshot_items(self, limit):
+        """
+        :return: list of up to limit (key, value) to snapshot, values in cache first,
+        then records of the old snapshot never used, copied without unpickling them
+        """
+        items = list(self.cache.items())[:limit]
+        keys = {key for key, _ in items}
+        for key in self.snapshot.keys(self.section):
+            if len(items) >= limit:
+                break
+            if key not in keys and key not in self.dropped:
+                items.append((key, self.snapshot.raw(self.section, key)))
+        return items
+
+
+def write_periodically(save, interval, stopped: threading.Event = None):
+    """
+    call save every interval seconds in a daemon thread until stopped is set
+
+    :return: stopped
+    """
+    stopped = stopped or threading.Event()
+
+    def loop():
+        while not stopped.wait(interval):
+            try:
+                save()
+            except Exception as e:
+                logging.error("writing snapshot failed: {}".format(e))
+
+    threading.Thread(target=loop, name='snapshot', daemon=True).start()
+    return stopped
@@ -0,0 +1,158 @@
+import threading
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from difflib import get_close_matches
+from time import monotonic
+
+from lru import LRU
+
+# Constants
+EMPTY_QUERY_TTL = 3600  # seconds a query without results is answered locally
+MAX_EMPTY_QUERIES = 4096
+MAX_PREFIX_SCAN = 1000  # tags with a prefix looked at to pick the most frequent
+FUZZY_CUTOFF = 0.75  # min similarity of a fuzzy match, see difflib
+MAX_FUZZY_CANDIDATES = 200  # tags sharing most trigrams with a query, compared by difflib
+
+
+def normalize_query(tags):
+    return tuple(sorted(tag.lower() for tag in tags))
+
+
+def trigrams(tag):
+    padded = ' {} '.format(tag)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TagIndex:
+    def __init__(self, empty_ttl=EMPTY_QUERY_TTL, max_empty_queries=MAX_EMPTY_QUERIES):
+        """
+        Index of tags of every picture seen, with their number of posts.
+        A post is counted once, however many times it is fetched again.
+        Tags are kept in a sorted array for prefix lookups, and in a trigram index
+        which narrows fuzzy matches down to a few candidates compared with difflib.
+        Queries found without results are remembered for empty_ttl seconds.
+        It is threading-safe.
+
+        :param empty_ttl: seconds a query without results is remembered
+
+        :param max_empty_queries: max number of queries without results remembered
+        """
+        self.counts = Counter()  # tag -> number of seen posts with it
+        self.picture_ids = set()  # ids of posts counted in counts
+        self.sorted_tags = []  # tags of counts, sorted when a lookup needs it
+        self.dirty = False
+        self.trigram_tags = defaultdict(set)  # trigram -> tags containing it
+        self.empty_ttl = empty_ttl
+        self.empty_queries = LRU(max_empty_queries)  # normalized query -> expiry time
+        self.lock = threading.Lock()
+
+    def add(self, tags, picture_id=None):
+        """
+        count tags of one post, unless the post was counted before
+
+        :param picture_id: id of post, None to count tags anyway
+        """
+        with self.lock:
+            if picture_id is not None:
+                if picture_id in self.picture_ids:
+                    return
+                self.picture_ids.add(picture_id)
+            for tag in tags:
+                if tag not in self.counts:
+                    self.index_tag(tag)
+                self.counts[tag] += 1
+
+    def index_tag(self, tag):
+        self.dirty = True
+        for gram in trigrams(tag):
+            self.trigram_tags[gram].add(tag)
+
+    def update(self, counts, picture_ids=()):
+        """
+        add counts of tags, like the ones of a snapshot
+
+        :param picture_ids: ids of posts counted in counts
+        """
+        with self.lock:
+            for tag in counts:
+                if tag not in self.counts:
+                    self.index_tag(tag)
+            self.counts.update(counts)
+            self.picture_ids.update(picture_ids)
+
+    def snapshot(self):
+        """
+        :return: (counts, picture_ids), copies of counts of tags and ids of posts counted
+        """
+        with self.lock:
+            return dict(self.counts), list(self.picture_ids)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __contains__(self, tag):
+        return tag in self.counts
+
+    def count(self, tag):
+        return self.counts.get(tag, 0)
+
+    def get_sorted_tags(self):
+        with self.lock:
+            if self.dirty:
+                self.sorted_tags = sorted(self.counts)
+                self.dirty = False
+            return self.sorted_tags
+
+    def complete(self, prefix, limit=6):
+        """
+        :return: up to limit most frequent tags starting with prefix
+        """
+        tags = self.get_sorted_tags()
+        start = bisect_left(tags, prefix)
+        matches = []
+        for i in range(start, min(len(tags), start + MAX_PREFIX_SCAN)):
+            if not tags[i].startswith(prefix):
+                break
+            matches.append(tags[i])
+        return sorted(matches, key=self.count, reverse=True)[:limit]
+
+    def fuzzy_candidates(self, tag):
+        """
+        :return: up to MAX_FUZZY_CANDIDATES tags sharing the most trigrams with tag
+        """
+        shared = Counter()
+        with self.lock:
+            for gram in trigrams(tag):
+                shared.update(self.trigram_tags.get(gram, ()))
+        return [t for t, _ in shared.most_common(MAX_FUZZY_CANDIDATES)]
+
+    def suggest(self, tag, limit=6):
+        """
+        :return: up to limit known tags which tag may be meant for, completions first
+        """
+        tag = tag.lower()
+        suggestions = [t for t in self.complete(tag, limit) if t != tag]
+        if len(suggestions) < limit:
+            for match in get_close_matches(tag, self.fuzzy_candidates(tag), n=limit, cutoff=FUZZY_CUTOFF):
+                if match != tag and match not in suggestions:
+                    suggestions.append(match)
+        return suggestions[:limit]
+
+    def mark_empty(self, tags):
+        """
+        remember query tags has no results
+        """
+        self.empty_queries[normalize_query(tags)] = monotonic() + self.empty_ttl
+
+    def is_known_empty(self, tags):
+        """
+        :return: True if query tags had no results within empty_ttl
+        """
+        query = normalize_query(tags)
+        expiry = self.empty_queries.get(query)
+        if expiry is None:
+            return False
+        if expiry < monotonic():
+            self.empty_queries.pop(query, None)
+            return False
+        return True
@@ -0,0 +1,103 @@
+import threading
+from array import array
+from collections.abc import Sequence
+
+
+class TagTable:
+    def __init__(self):
+        """
+        Intern table mapping each distinct tag to a small int id and back,
+        so tags of cached pictures are held once however many pictures share them.
+        It is threading-safe.
+        """
+        self.ids = {}  # tag -> id
+        self.tags = []  # id -> tag
+        self.lock = threading.Lock()
+
+    def intern(self, tag):
+        """
+        :return: id of tag, assigned when it is new
+        """
+        tag_id = self.ids.get(tag)
+        if tag_id is None:
+            with self.lock:
+                tag_id = self.ids.get(tag)
+                if tag_id is None:
+                    tag_id = len(self.tags)
+                    self.tags.append(tag)
+                    self.ids[tag] = tag_id
+        return tag_id
+
+    def tag(self, tag_id):
+        return self.tags[tag_id]
+
+    def __len__(self):
+        return len(self.tags)
+
+
+class InternedTags(Sequence):
+    __slots__ = ('table', 'ids')
+
+    def __init__(self, table: TagTable, tags):
+        """
+        Read-only sequence of tags stored as an array of ids of table.
+        It replaces the list of tag strings of a picture.
+
+        :param table: TagTable the ids belong to
+
+        :param tags: iterable of tag strings
+        """
+        self.table = table
+        self.ids = array('I', (table.intern(tag) for tag in tags))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.table.tags[tag_id] for tag_id in self.ids[index]]
+        return self.table.tags[self.ids[index]]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        tags = self.table.tags
+        return (tags[tag_id] for tag_id in self.ids)
+
+    def __contains__(self, tag):
+        tag_id = self.table.ids.get(tag)
+        return tag_id is not None and tag_id in self.ids
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __reduce__(self):
+        # ids only make sense within one table, so pickle the strings and intern them again
+        return load_interned_tags, (list(self),)
+
+
+tag_table = TagTable()
+
+
+def load_interned_tags(tags):
+    return InternedTags(tag_table, tags)
+
+
+def intern_tags(pictures, on_new=None):
+    """
+    replace tags of pictures by interned ones in place
+
+    :param pictures: iterable of Gelbooru pictures, or None
+
+    :param on_new: function called with tags and id of every picture not interned before.
+    A picture fetched again is a new object, so it may be called more than once for an id.
+
+    :return: pictures
+    """
+    for p in pictures or ():
+        if not isinstance(p.tags, InternedTags):
+            p.tags = InternedTags(tag_table, p.tags)
+            if on_new:
+                on_new(p.tags, p.picture_id)
+    return pictures
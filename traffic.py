@@ -0,0 +1,71 @@
+"""
+Record incoming updates to a compact log, and read recorded traffic back for replay.py.
+
+A compact log has one JSON line per update: [received timestamp, update dict].
+"""
+import heapq
+import json
+import pickle
+from threading import Lock
+from time import time
+
+import telegram
+
+
+class TrafficRecorder:
+    def __init__(self, file_name):
+        """
+        Append every update to a compact log. Use record as callback of a TypeHandler.
+        It is threading-safe.
+
+        :param file_name: path of the compact log
+        """
+        self.file_name = file_name
+        self.lock = Lock()
+        self.fp = open(file_name, 'a', buffering=1)
+
+    def record(self, bot: telegram.Bot, update: telegram.Update):
+        line = json.dumps([round(time(), 3), update.to_dict()], separators=(',', ':'))
+        with self.lock:
+            self.fp.write(line + '\n')
+
+
+def read_compact_log(file_name):
+    """
+    :return: generator of (timestamp, update dict) in recorded order
+    """
+    with open(file_name, 'r') as fp:
+        for line in fp:
+            if line.strip():
+                timestamp, data = json.loads(line)
+                yield timestamp, data
+
+
+def read_message_records(file_name):
+    """
+    read messages pickled by chat.record into a message_of_<chat_id> file
+
+    :return: generator of (timestamp, update dict) in recorded order
+    """
+    with open(file_name, 'rb') as fp:
+        while True:
+            try:
+                message = pickle.load(fp)
+            except EOFError:
+                break
+            yield message.date.timestamp(), {'update_id': 0, 'message': message.to_dict()}
+
+
+def read_traffic(file_names):
+    """
+    read recorded traffic from compact logs (*.jsonl) and message_of_<chat_id> files
+
+    :param file_names: paths of recordings
+
+    :return: generator of (timestamp, update dict) of all recordings, ordered by timestamp
+    """
+    streams = [
+        read_compact_log(name) if name.endswith('.jsonl') else read_message_records(name)
+        for name in file_names
+    ]
+    return heapq.merge(*streams, key=lambda item: item[0])
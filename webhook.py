@@ -0,0 +1,113 @@
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from queue import Queue, Empty
+from socketserver import ThreadingMixIn
+from threading import Thread
+
+import telegram
+
+
+class UpdateRequestHandler(BaseHTTPRequestHandler):
+    # keep connections alive between posts
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if self.path.rstrip('/') != self.server.path.rstrip('/'):
+            self.reply(404)
+            return
+        try:
+            data = json.loads(body.decode('utf-8'))
+        except ValueError:
+            self.reply(400)
+            return
+        # Telegram posts one update, the fake sender may post a list of them
+        self.server.receive(data if isinstance(data, list) else [data])
+        self.reply(200)
+
+    def reply(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # requests are too many to log one by one
+        pass
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, bot: telegram.Bot, update_queue: Queue, path='/', batch_size=64):
+        """
+        HTTP server which receives updates posted by Telegram and puts them into update_queue.
+        Requests are answered before updates are decoded, decoding is done by
+        one thread in batches.
+
+        :param address: (host, port) to listen on
+
+        :param bot: bot which decoded updates are bound to
+
+        :param update_queue: queue of the dispatcher, such as updater.update_queue
+
+        :param path: url path to accept updates on
+
+        :param batch_size: max updates decoded at a time
+        """
+        super().__init__(address, UpdateRequestHandler)
+        self.bot = bot
+        self.update_queue = update_queue
+        self.path = path
+        self.batch_size = batch_size
+        self.raw_updates = Queue()
+        self.decoder = Thread(target=self.decode_forever, name='webhook_decoder', daemon=True)
+        self.decoder.start()
+
+    def receive(self, items):
+        for data in items:
+            self.raw_updates.put(data)
+
+    def decode_forever(self):
+        while True:
+            batch = [self.raw_updates.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.raw_updates.get_nowait())
+                except Empty:
+                    break
+            for data in batch:
+                try:
+                    update = telegram.Update.de_json(data, self.bot)
+                except Exception as e:
+                    logging.error("can not decode update {}: {}".format(data, e))
+                    continue
+                self.update_queue.put(update)
+
+
+def start_webhook(updater, listen, port, path, url='', batch_size=64):
+    """
+    start dispatcher and job queue of updater, and a webhook server feeding them.
+    The server is returned without serving, call serve_forever() on it.
+
+    :param updater: telegram.ext.Updater
+
+    :param listen: host to listen on
+
+    :param port: port to listen on
+
+    :param path: url path of the webhook
+
+    :param url: public url registered to Telegram. Not registered if empty.
+
+    :param batch_size: max updates decoded at a time
+
+    :return: WebhookServer
+    """
+    server = WebhookServer((listen, port), updater.bot, updater.update_queue, path, batch_size)
+    Thread(target=updater.dispatcher.start, name='dispatcher', daemon=True).start()
+    updater.job_queue.start()
+    if url:
+        updater.bot.set_webhook(url=url)
+    return server